@@ -39,13 +39,11 @@ def bookMiniApp(tablet: TabletInterface, root:str, chapters: dict):
         if type(v) == dict:
             def callback(x, chapters=v):
                 bookMiniApp(tablet, root, chapters)
-                display.fillScreen(0)
-                window.render(display)
+                window.invalidate()
         elif type(v) == str:
             def callback(x, name=v):
                 pageMiniApp(tablet, os.path.join(root, name))
-                display.fillScreen(0)
-                window.render(display)
+                window.invalidate()
         else:
             continue
         elements.append(TextButtonElement(30, 40 + i*20, 480, 15, k, 0x202020, callback))
@@ -90,8 +88,7 @@ class LibraryApp(Application):
         for i in range(len(books)):
             def callback(x, i=i):
                 bookMiniApp(tablet, books[i].path, books[i].chapters)
-                display.fillScreen(0)
-                self.window.render(display)
+                self.window.invalidate()
             elements.append(books[i].getIconAsElement(5 + i * 80, 50, callback))
 
         self.window = ApplicationWindow(elements)
@@ -18,6 +18,11 @@
 #define CMD_SELECT_DISPLAY      0x09
 #define CMD_DRAW_PALETTE_IMAGE  0x0A
 #define CMD_FILL_DISPLAY        0x0B
+#define CMD_SET_VIBRATE         0x0C
+#define CMD_WRITE_VRAM_RLE      0x0D
+#define CMD_WRITE_VRAM_RANGE    0x0E
+#define CMD_WRITE_TEXT_BLOCK    0x0F
+#define CMD_SET_BAUD            0x10
 
 #define EVENT_ON_CTP_CHANGE     0x01
 #define EVENT_BATTERY_DATA      0x02
@@ -29,6 +34,7 @@
 #define PERIPHERALD_VRAM_SIZE           1024 * 256
 
 #define PERIPHERALD_BATTERY_CHECK_MS  1000
+#define PERIPHERALD_BAUD_VERIFY_MS    1000
 #define PERIPHERALD_TOUCH_CHECK_MS    8
 
 #define debug(...) Serial.printf(__VA_ARGS__)
@@ -45,6 +51,9 @@ uint8_t _peripherald_serial_buffer[PERIPHERALD_SERIAL_BUFFER_SIZE];
 bool _is_peripherald_loading = true;
 int peripherald_num_vram_sectors;
 
+// Rate of the link to the Pi, which hw.cpp starts at 115200
+uint32_t peripherald_baud = 115200;
+
 /*
  * Wait for a string from the Pi's serial port
  * 
@@ -380,8 +389,9 @@ void peripherald(void* arg) {
       peripherald_send_updates_to_companion();
     }
 
-    // Read in the data
-    while (pi_serial->available()) {
+    // Read in the data.  When the buffer is full, the rest waits in the UART until we've
+    // processed some commands.  The host's flow control keeps it from getting that far.
+    while (pi_serial->available() && i < PERIPHERALD_SERIAL_BUFFER_SIZE) {
       char c = pi_serial->read();
       _peripherald_serial_buffer[i++] = c;
       Serial.printf("%.02hhx ", c);
@@ -422,6 +432,99 @@ void drawPaletteImage16(uint16_t x, uint16_t y, uint8_t w, uint8_t ys, uint16_t*
   }
 }
 
+/*
+ * Decompresses one run-length encoded VRAM sector (see utils/compression.py)
+ *
+ * Each chunk starts with a control byte.  If its high bit is set, the next word is
+ * repeated (control & 0x7F) + 1 times, otherwise (control + 1) words follow as they are.
+ * Whatever the data doesn't cover is filled with zeros.
+ */
+static void decode_rle_sector(uint16_t* dest, const char* src, int len) {
+  int n = 0;
+  int i = 0;
+  while (i < len && n < 256) {
+    uint8_t control = (uint8_t)src[i++];
+    int count = (control & 0x7F) + 1;
+
+    if (control & 0x80) {
+      if (len - i < 2)
+        break;
+
+      uint16_t word = ((uint8_t)src[i] << 8) | (uint8_t)src[i + 1];
+      i += 2;
+      while (count-- > 0 && n < 256)
+        dest[n++] = word;
+    } else {
+      while (count-- > 0 && n < 256 && len - i >= 2) {
+        dest[n++] = ((uint8_t)src[i] << 8) | (uint8_t)src[i + 1];
+        i += 2;
+      }
+    }
+  }
+
+  while (n < 256)
+    dest[n++] = 0;
+}
+
+/*
+ * Writes a paragraph of text, wrapped at spaces once a line has more than chars_per_line
+ * characters.  This has to wrap exactly like splitlines() in utils/stringutil.py.
+ */
+static void write_text_block(uint16_t x, uint16_t y, uint8_t line_height, uint8_t chars_per_line, const char* text, int len) {
+  int chars_in_line = 0;
+  int last_space_index = -1;
+  int line_start = 0;
+
+  for (int i = 0; i < len; i++) {
+    if (text[i] == ' ')
+      last_space_index = i;
+    chars_in_line++;
+
+    // The space we split at isn't drawn, so the line really is short enough
+    if (chars_in_line > chars_per_line && last_space_index != -1) {
+      builtin_display->setTextCursorPixels(x, y);
+      builtin_display->write(&text[line_start], last_space_index - line_start);
+      y += line_height;
+
+      line_start = last_space_index + 1;
+      chars_in_line = i - line_start;
+      last_space_index = -1;
+    }
+  }
+
+  builtin_display->setTextCursorPixels(x, y);
+  builtin_display->write(&text[line_start], len - line_start);
+}
+
+/*
+ * Switches the link to the Pi to a new baud rate
+ *
+ * The command is acknowledged at the old rate.  Then the Pi has PERIPHERALD_BAUD_VERIFY_MS
+ * to send CMD_REQUEST_ACKNOWLEDGE at the new rate, which we acknowledge at the new rate.
+ * If it doesn't, we go back to the old rate.
+ */
+static void change_baud(uint32_t baud) {
+  pi_serial->write(EVENT_ACKNOWLEDGE);
+  pi_serial->flush();
+  pi_serial->setBaud(baud);
+
+  long start_time = millis();
+  while (millis() - start_time < PERIPHERALD_BAUD_VERIFY_MS) {
+    // Anything else is noise from the Pi switching over
+    if (pi_serial->available() && pi_serial->read() == CMD_REQUEST_ACKNOWLEDGE) {
+      pi_serial->write(EVENT_ACKNOWLEDGE);
+      peripherald_baud = baud;
+      debug("Link is now at %lu baud\n", baud);
+      return;
+    }
+
+    bootloader_yield();
+  }
+
+  pi_serial->setBaud(peripherald_baud);
+  debug("No reply at %lu baud, staying at %lu\n", baud, peripherald_baud);
+}
+
 /*
  * Processes commands
  */
@@ -436,6 +539,17 @@ int process_gpu_commands(const char* src, int len) {
       i++;
       pi_serial->write(EVENT_ACKNOWLEDGE);
 
+    } else if (command == CMD_SET_BAUD) {
+      if (len - i < 5)
+        break;
+
+      i++;
+      uint32_t baud = 0;
+      for (int j = 0; j < 4; j++)
+        baud = (baud << 8) | (uint8_t)src[i++];
+
+      change_baud(baud);
+
     } else if (command == CMD_SET_CURSOR_PIXELS) {
       if (len - i < 5)
         break;
@@ -462,6 +576,38 @@ int process_gpu_commands(const char* src, int len) {
       builtin_display->write(&src[++i], s_len);
       i += s_len;
 
+    } else if (command == CMD_WRITE_TEXT_BLOCK) {
+      if (len - i < 11)
+        break;
+
+      uint16_t text_len = ((uint8_t)src[i + 9] << 8) | (uint8_t)src[i + 10];
+      if (text_len > PERIPHERALD_SERIAL_BUFFER_SIZE - 11) {
+        // Could never fit in the buffer, so it can't be a real command
+        i++;
+        continue;
+      }
+      if (len - i - 11 < text_len)
+        break;
+
+      i++;
+      uint8_t xh = (uint8_t)src[i++];
+      uint8_t xl = (uint8_t)src[i++];
+      uint8_t yh = (uint8_t)src[i++];
+      uint8_t yl = (uint8_t)src[i++];
+      uint8_t line_height = (uint8_t)src[i++];
+      uint8_t chars_per_line = (uint8_t)src[i++];
+      uint8_t ch = (uint8_t)src[i++];
+      uint8_t cl = (uint8_t)src[i++];
+      i += 2;
+
+      uint16_t x = ((uint16_t)xh << 8) | xl;
+      uint16_t y = ((uint16_t)yh << 8) | yl;
+      uint16_t c = ((uint16_t)ch << 8) | cl;
+
+      builtin_display->setTextColor(c);
+      write_text_block(x, y, line_height, chars_per_line, &src[i], text_len);
+      i += text_len;
+
     } else if (command == CMD_DRAW_PIXEL) {
       if (len - i < 7)
         break;
@@ -568,6 +714,61 @@ int process_gpu_commands(const char* src, int len) {
       //Serial.println("Wrote the VRAM");
       //Serial.flush();
 
+    } else if (command == CMD_WRITE_VRAM_RLE) {
+      if (len - i < 5)
+        break;
+
+      uint16_t data_len = ((uint8_t)src[i + 3] << 8) | (uint8_t)src[i + 4];
+      if (data_len > PERIPHERALD_SERIAL_BUFFER_SIZE - 5) {
+        // Could never fit in the buffer, so it can't be a real command
+        i++;
+        continue;
+      }
+      if (len - i - 5 < data_len)
+        break;
+
+      i++;
+      uint8_t ih = (uint8_t)src[i++];
+      uint8_t il = (uint8_t)src[i++];
+      size_t index = (((uint32_t)ih << 16) | ((uint32_t)il << 8));
+      i += 2;
+
+      const char* data = &src[i];
+      i += data_len;
+
+      if (index >= (peripherald_num_vram_sectors << 8)) {
+        continue;
+      }
+
+      decode_rle_sector(&(vram[index]), data, data_len);
+
+    } else if (command == CMD_WRITE_VRAM_RANGE) {
+      if (len - i < 7)
+        break;
+
+      uint16_t n_words = ((uint8_t)src[i + 5] << 8) | (uint8_t)src[i + 6];
+      if (n_words > (PERIPHERALD_SERIAL_BUFFER_SIZE - 7) / 2) {
+        // Could never fit in the buffer, so it can't be a real command
+        i++;
+        continue;
+      }
+      if (len - i - 7 < n_words * 2)
+        break;
+
+      i++;
+      size_t index = 0;
+      for (int j = 0; j < 4; j++)
+        index = (index << 8) | (uint8_t)src[i++];
+      i += 2;
+
+      // Words past the end of VRAM are dropped
+      size_t vram_words = peripherald_num_vram_sectors << 8;
+      for (int j = 0; j < n_words; j++) {
+        if (index + j < vram_words)
+          vram[index + j] = ((uint8_t)src[i] << 8) | (uint8_t)src[i + 1];
+        i += 2;
+      }
+
     } else if (command == CMD_RENDER_BITMAP) {
       if (len - i < 9)
         break;
@@ -594,6 +795,13 @@ int process_gpu_commands(const char* src, int len) {
 
       Serial.printf("RenderBitmap (%hu, %hu) sz=[%hu, %hu] @%lu\n", x, y, xs, ys, index);
 
+    } else if (command == CMD_SET_VIBRATE) {
+      if (len - i < 2)
+        break;
+
+      i++;
+      set_vibrator_state(src[i++] != 0);
+
     } else if (command == CMD_SELECT_DISPLAY) {
       if (len - i < 2)
         break;
@@ -0,0 +1,246 @@
+'''
+Measures what drawing the UI costs on the link to the tablet.
+
+Each workload drives the real UI code against LoopbackStream, a stand-in for peripherald
+that parses the command stream without drawing anything, and plays back scripted taps
+whenever the UI waits for input.  For every workload this reports the bytes and commands
+sent, the host CPU time, and how long the link would take to carry it at each baud rate.
+
+Run it from the src directory:  python3 benchmark.py [--opcodes] [--baud RATE ...]
+'''
+
+import argparse
+import collections
+import json
+import os
+import time
+
+from PIL import Image, ImageDraw, UnidentifiedImageError
+
+from utils import protocol
+from utils.protocol import TabletInterface, getCommandSize
+
+DEFAULT_BAUD_RATES = [115200, 1000000, 3000000]
+
+# Names of the command bytes, for the opcode breakdown
+COMMAND_NAMES = {v: k[len('COMMAND_'):] for k, v in vars(protocol).items() if k.startswith('COMMAND_') and type(v) == int}
+
+
+class ScriptFinished(Exception):
+    '''Raised when a workload waits for input after its script has run out.'''
+
+
+class LoopbackStream:
+    '''
+    Answers the host like peripherald, without a display.  Commands are parsed and counted,
+    acknowledgements are sent where the firmware would send them, and scripted events are
+    played back one at a time whenever the host waits for input.
+    '''
+
+    def __init__(self):
+        self.script = collections.deque()
+        self._input_buffer = bytearray()
+        self._output_buffer = bytearray()
+        self.reset()
+
+    def reset(self):
+        '''Starts counting from zero, so a workload can leave its setup out of the results.'''
+        self.bytes_received = 0
+        self.command_counts = collections.Counter()
+        self.start_time = time.process_time()
+
+        # CPU time spent in here, which isn't the host's
+        self.cpu_time = 0
+
+    def tap(self, x, y):
+        '''Adds a touch at (x, y) followed by a release to the script.'''
+        self.script.append(bytes([protocol.EVENT_ON_CTP_CHANGE, 1]) + protocol.EVENT_LAYOUT_TOUCH.pack(x, y, 500))
+        self.script.append(bytes([protocol.EVENT_ON_CTP_CHANGE, 0]))
+
+    def write(self, data):
+        start = time.process_time()
+        self.bytes_received += len(data)
+
+        buf = self._input_buffer
+        buf += data
+        i = 0
+        while i < len(buf):
+            size = getCommandSize(buf, i)
+            if size is None or i + size > len(buf):
+                break
+
+            cmd = buf[i]
+            self.command_counts[cmd] += 1
+            if cmd == protocol.COMMAND_REQUEST_ACKNOWLEDGE or cmd == protocol.COMMAND_SET_BAUD:
+                self._output_buffer.append(protocol.EVENT_ACKNOWLEDGE)
+            i += size
+
+        del buf[:i]
+        self.cpu_time += time.process_time() - start
+
+    def available(self):
+        return len(self._output_buffer) > 0
+
+    def wait(self, timeout = None):
+        if len(self._output_buffer) == 0 and len(self.script) > 0:
+            self._output_buffer += self.script.popleft()
+
+        if len(self._output_buffer) == 0 and timeout is None:
+            raise ScriptFinished()
+        return len(self._output_buffer) > 0
+
+    def read(self):
+        data = bytes(self._output_buffer)
+        self._output_buffer.clear()
+        return data
+
+    def setBaud(self, baud):
+        pass
+
+
+def _placeholderImage(size = 96):
+    # A flat-colored icon, like the real ones
+    image = Image.new('RGB', (size, size), (32, 32, 96))
+    draw = ImageDraw.Draw(image)
+    draw.rectangle((size // 4, size // 8, size * 3 // 4, size * 7 // 8), fill=(220, 200, 160))
+    draw.line((size // 2, size // 8, size // 2, size * 7 // 8), fill=(120, 80, 40), width=3)
+    return image
+
+
+def substituteMissingImages():
+    '''
+    Checkouts without git LFS only have pointer files in place of the PNGs.  This makes
+    Image.open return a placeholder for those, so the workloads can still run.  Returns a
+    list that gets the path of every substituted file.
+    '''
+    substituted = []
+    open_image = Image.open
+
+    def openOrPlaceholder(fp, *args, **kwargs):
+        try:
+            return open_image(fp, *args, **kwargs)
+        except UnidentifiedImageError:
+            substituted.append(fp)
+            return _placeholderImage()
+
+    Image.open = openOrPlaceholder
+    return substituted
+
+
+def _bookPages(root, chapters):
+    for name, value in chapters.items():
+        if type(value) == dict:
+            yield from _bookPages(root, value)
+        elif type(value) == str:
+            yield os.path.join(root, value)
+
+
+def getWorkloads():
+    '''Returns (name, function) pairs.  Each function drives the UI on a fresh TabletInterface.'''
+    # Imported here, since they open images as soon as they're imported or constructed
+    import shell
+    from application.library import LibraryApp, pageMiniApp
+    from ui import ErrorPopupBox, PopupBox
+
+    def home(tablet, stream):
+        with tablet.frame():
+            shell.SystemShell([LibraryApp()]).drawHome(tablet.getDisplay())
+
+    def homeRedraw(tablet, stream):
+        home_shell = shell.SystemShell([LibraryApp()])
+        with tablet.frame():
+            home_shell.drawHome(tablet.getDisplay())
+        stream.reset()
+        with tablet.frame():
+            home_shell.drawHome(tablet.getDisplay())
+
+    def library(tablet, stream):
+        # Open it, then press "<- Exit"
+        stream.tap(30, 25)
+        LibraryApp().main(tablet)
+
+    def popup(tablet, stream):
+        # Show an error, then press "Ok"
+        box = ErrorPopupBox(ValueError("Something went wrong while loading the book"))
+        stream.tap(400, (480 + box.height) // 2 - PopupBox.BUTTON_HEIGHT // 2)
+        box.mainloop(tablet)
+
+    workloads = [('home', home), ('home (redraw)', homeRedraw), ('library', library)]
+
+    books_root = '../books_builtin'
+    for book in sorted(os.listdir(books_root)):
+        with open(os.path.join(books_root, book, 'info.json')) as f:
+            chapters = json.load(f)['chapters']
+
+        for path in _bookPages(os.path.join(books_root, book), chapters):
+            if not os.path.exists(path):
+                continue
+
+            def page(tablet, stream, path=path):
+                # Open the page, then press "<- Back"
+                stream.tap(30, 25)
+                pageMiniApp(tablet, path)
+
+            workloads.append(('page ' + os.path.relpath(path, books_root), page))
+
+    workloads.append(('popup', popup))
+    return workloads
+
+
+def runWorkload(function):
+    '''Runs a workload, and returns the LoopbackStream it ran against and the host CPU time.'''
+    stream = LoopbackStream()
+    tablet = TabletInterface(stream)
+
+    # Every run starts cold, without encoded images from earlier runs
+    tablet.display.payload_cache = None
+
+    stream.reset()
+    try:
+        function(tablet, stream)
+    except ScriptFinished:
+        pass
+    tablet.flush()
+    cpu_time = time.process_time() - stream.start_time - stream.cpu_time
+
+    return stream, cpu_time
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measures the link cost of UI workloads.")
+    parser.add_argument('--baud', type=int, action='append', help="baud rate to model (repeatable)")
+    parser.add_argument('--opcodes', action='store_true', help="break down each workload by command")
+    parser.add_argument('--only', help="only run workloads whose name contains this")
+    args = parser.parse_args()
+    baud_rates = args.baud or DEFAULT_BAUD_RATES
+
+    # The library paths are relative to src
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+    substituted = substituteMissingImages()
+
+    header = f"{'workload':<64} {'bytes':>8} {'cmds':>6} {'cpu ms':>8}"
+    for baud in baud_rates:
+        header += f" {f'@{baud} ms':>12}"
+    print(header)
+
+    for name, function in getWorkloads():
+        if args.only is not None and args.only not in name:
+            continue
+
+        stream, cpu_time = runWorkload(function)
+        row = f"{name:<64} {stream.bytes_received:>8} {sum(stream.command_counts.values()):>6} {cpu_time * 1000:>8.1f}"
+        for baud in baud_rates:
+            # 8N1 framing puts 10 bits on the wire for every byte
+            row += f" {stream.bytes_received * 10 / baud * 1000:>12.1f}"
+        print(row)
+
+        if args.opcodes:
+            for cmd, count in stream.command_counts.most_common():
+                print(f"    {COMMAND_NAMES.get(cmd, hex(cmd)):<24} {count:>6}")
+
+    if len(substituted) > 0:
+        print(f"\n{len(set(substituted))} images couldn't be read (git LFS pointers?) and were replaced by placeholders")
+
+
+if __name__ == '__main__':
+    main()
@@ -8,6 +8,9 @@ from ui import *
 
 from PIL import Image
 
+# Baud rate to ask the tablet for once we've started
+FAST_BAUD = 1000000
+
 is_real_tablet = platform.is_real_tablet()
 
 if not is_real_tablet:
@@ -15,7 +18,7 @@ if not is_real_tablet:
 
     # We don't import tkinter by default because it shouldn't be installed
     # on the real tablet, only on machines doing simulation.
-    # Importing the simulation modules will import tkinter.
+    # The simulator imports tkinter once it opens its window.
     from simulator import peripherald
 
     stream = peripherald.PeripheraldEmulator(scale = 2)
@@ -28,6 +31,9 @@ else:
 tablet = protocol.TabletInterface(stream)
 display = tablet.getDisplay()
 
+# Speed up the link if the tablet supports it, otherwise stay at the default rate
+tablet.setBaud(FAST_BAUD)
+
 #display.fillScreen(0x202020)
 
 sys = shell.SystemShell([
@@ -1,7 +1,6 @@
 import traceback
 
 from PIL import Image
-import time
 
 from ui import ErrorPopupBox
 from utils.protocol import TabletInterface
@@ -52,9 +51,11 @@ class SystemShell:
 
     def mainloop(self, tablet: TabletInterface):
         display = tablet.getDisplay()
-        self.drawHome(display)
+        with tablet.frame():
+            self.drawHome(display)
+
         while True:
-            time.sleep(0.010)
+            tablet.waitEvent()
             for point in tablet.getPresses():
                 x = point[0]
                 y = point[1]
@@ -67,10 +68,12 @@ class SystemShell:
                         app = self.applications[app_idx]
                         app.main(tablet)
                 except Exception as e:
-                    self.drawHome(display)
+                    with tablet.frame():
+                        self.drawHome(display)
                     popup = ErrorPopupBox(str(e))
                     popup.mainloop(tablet)
                     # traceback.print_exc()
 
                 # Re-render the homescreen
-                self.drawHome(display)
+                with tablet.frame():
+                    self.drawHome(display)
@@ -1,3 +1,7 @@
+import re
+
+import numpy as np
+
 
 cpp_font_data = '''
 {
@@ -1320,15 +1324,32 @@ cpp_font_data = '''
 }
 '''
 
-cpp_data_no_comments = ''
-for i in cpp_font_data.split('\n'):
-    comment_start = i.find('//')
-    if comment_start != -1:
-        i = i[:comment_start]
+# Every row of every glyph, in order, skipping the character names in the comments
+_rows = [int(row, 2) for row in re.findall(r'\b0b([01]+)', cpp_font_data)]
+
+CHAR_WIDTH = 8
+CHAR_HEIGHT = 12
+FIRST_CHAR = 0x21
+
+character_data = [_rows[i:i + CHAR_HEIGHT] for i in range(0, len(_rows), CHAR_HEIGHT)]
+
+# Bit 8 - x of each row is column x, the same as the firmware
+_row_masks = (np.array(_rows, dtype=np.uint16)[:, None] >> np.arange(8, 0, -1)) & 1 == 1
+
+# Mask of the set pixels of every byte value, indexed [char, y, x].  Characters without a
+# glyph, like space, are blank.
+glyph_masks = np.zeros((256, CHAR_HEIGHT, CHAR_WIDTH), dtype=bool)
+glyph_masks[FIRST_CHAR:FIRST_CHAR + len(character_data)] = _row_masks.reshape((-1, CHAR_HEIGHT, CHAR_WIDTH))
+
 
-    cpp_data_no_comments += i
+def text_mask(text):
+    '''
+    Returns the mask of the pixels set by a line of text (bytes), as a bool array indexed
+    [y, x] that is CHAR_HEIGHT high and CHAR_WIDTH wide for every character.
+    '''
+    glyphs = glyph_masks[np.frombuffer(text, dtype=np.uint8)]
+    return glyphs.transpose((1, 0, 2)).reshape((CHAR_HEIGHT, len(text) * CHAR_WIDTH))
 
-character_data = eval(cpp_data_no_comments.replace('{', '[').replace('}', ']'))
 
 def draw_char_on_canvas(pixelDrawer, bx, by, c, color_hex_str):
     if type(c) == str:
@@ -1336,8 +1357,5 @@ def draw_char_on_canvas(pixelDrawer, bx, by, c, color_hex_str):
     elif type(c) == bytes:
         c = c[0]
 
-    bitmap = character_data[c - 0x21]
-    for y in range(len(bitmap)):
-        for x in range(8):
-            if 1 & (bitmap[y] >> (8 - x)) == 1:
-                pixelDrawer.setPixel(bx + x, by + y, color_hex_str)
+    for y, x in zip(*np.nonzero(glyph_masks[c & 0xFF])):
+        pixelDrawer.setPixel(bx + int(x), by + int(y), color_hex_str)
@@ -1,254 +1,235 @@
 
-import tkinter as tk
+import threading
 import time, _thread
-from . import ntios_font
-from PIL import ImageTk, Image, ImageDraw
+from PIL import Image
+from utils.framebuffer import Framebuffer
+from utils.protocol import getCommandSize, EVENT_LAYOUT_TOUCH
 #from .input import Input
 
-COMMAND_SET_TEXT_CURSOR    = 0x01
-COMMAND_WRITE_TEXT         = 0x02
-COMMAND_DRAW_PIXEL         = 0x03
-COMMAND_FILL_RECT          = 0x04
-COMMAND_DRAW_RECT          = 0x05
-COMMAND_SET_TEXT_COLOR     = 0x06
-COMMAND_WRITE_VRAM         = 0x07
-COMMAND_DRAW_BITMAP        = 0x08
-COMMAND_SELECT_DISPLAY     = 0x09
-COMMAND_DRAW_PALETTE_IMAGE = 0x0A
-COMMAND_FILL_DISPLAY       = 0x0B
+COMMAND_REQUEST_ACKNOWLEDGE = 0x00
 COMMAND_SET_VIBRATE        = 0x0C
+COMMAND_SET_BAUD           = 0x10
 
 EVENT_ON_CTP_CHANGE = 0x01
 EVENT_BATTERY_DATA  = 0x02
 EVENT_ON_KEYPRESS   = 0x03
+EVENT_ACKNOWLEDGE   = 0xFF
 
 
-def u16_to_rgb(c):
-    blue = (c << 3) & 0xFF
-    green = (c >> 3) & 0xFC
-    red = (c >> 8) & 0xF8
-
-    return (red, green, blue)
+class PeripheraldEmulator:
+    '''
+    Stands in for the tablet's display processor.  Every command is drawn into a
+    Framebuffer, an RGB565 array of the whole screen, so it runs without a display.
 
+    Unless headless is set, a Tk window shows the framebuffer, scaled up by scale, and
+    sends touches and key presses from it.  Headless emulators can be given input with
+    sendTouch(), sendRelease() and sendKey(), and read back with framebuffer.
 
-def RGBtoStr(ombreRGB):
-    color = "#"
-    for rgb in ombreRGB:
-        if rgb < 16:
-            color+="0"
-        color+=format(int(rgb), 'x')
-    return color
+    The window is a single image, which is brought up to date at most MAX_FPS times a
+    second, so it costs the same however long the emulator runs.
+    '''
 
+    # Most times a second the window is redrawn
+    MAX_FPS = 30
 
-class PeripheraldEmulator:
-    def __init__(self, screen_res = (800, 480), scale = 1, vram_sectors=1024):
+    def __init__(self, screen_res = (800, 480), scale = 1, vram_sectors=1024, headless = False):
         if type(scale) != int:
             raise ValueError("scale parameter must be an integer")
 
         self.screen_res = screen_res
         self.scale = scale
+        self.headless = headless
         self._canvas_width = screen_res[0] * scale
         self._canvas_height = screen_res[1] * scale
         self.output_buffer = b''
-        self.text_cursor = (0, 0)
-        self.text_color = '#FFFFFF'
-        self.vram = [0] * (vram_sectors * 256)
-        self.imcache = []
+        self._output_ready = threading.Condition()
+        self.input_buffer = bytearray()
+
+        # Rate of the emulated serial link, which sets how long writes take
+        self.baud = 115200
+        self.framebuffer = Framebuffer(screen_res[0], screen_res[1], vram_sectors)
 
-        _thread.start_new_thread(self.mainloop, ())
+        # (x1, y1, x2, y2) around everything drawn since the window was last redrawn
+        self._dirty_rect = None
+        self._dirty_lock = threading.Lock()
 
-        while not hasattr(self, 'canvas'):
-            time.sleep(0.01)
+        # The framebuffer's uint16 array, which VRAM writes update in place
+        self.vram = self.framebuffer.vram
+
+        if not headless:
+            _thread.start_new_thread(self.mainloop, ())
+
+            while not hasattr(self, 'canvas'):
+                time.sleep(0.01)
 
     def mainloop(self):
+        # Only needed for the window, so headless emulators work without tkinter
+        import tkinter as tk
+
         # init tk
         self.root = tk.Tk()
 
         # create canvas
-        self.canvas = tk.Canvas(
-            self.root, bg="black",
+        canvas = tk.Canvas(
+            self.root, bg="black", highlightthickness=0,
             height=self._canvas_height, width=self._canvas_width)
 
-        self.canvas.bind("<ButtonPress-1>", self.onDragStartCB)
-        self.canvas.bind("<ButtonRelease-1>", self.onDragStopCB)
-        self.canvas.bind("<B1-Motion>", self.onDragPointCB)
-        self.canvas.pack()
+        # The whole screen is one image, which is updated in place
+        self._screen_image = tk.PhotoImage(width=self._canvas_width, height=self._canvas_height)
+        canvas.create_image((0, 0), image=self._screen_image, anchor='nw')
+
+        canvas.bind("<ButtonPress-1>", self.onDragStartCB)
+        canvas.bind("<ButtonRelease-1>", self.onDragStopCB)
+        canvas.bind("<B1-Motion>", self.onDragPointCB)
+        self.root.bind("<Key>", self.onKeyPressCB)
+        canvas.pack()
+        self.canvas = canvas
 
         # add to window and show
+        self._markDirty([(0, 0) + tuple(self.screen_res)])
+        self._refreshView()
         self.root.mainloop()
 
         quit(0)
 
-    def setPixel(self, x, y, color):
-        if type(color) == str:
-            rgb_str = color
-        else:
-            rgb = u16_to_rgb(color)
-            rgb_str = RGBtoStr(rgb)
+    def _refreshView(self):
+        from PIL import ImageTk
+
+        # Runs on the Tk thread, and schedules itself for the next frame
+        self.root.after(1000 // self.MAX_FPS, self._refreshView)
+
+        with self._dirty_lock:
+            rect = self._dirty_rect
+            self._dirty_rect = None
+        if rect is None:
+            return
+
+        # Anything drawn while this is copied is marked dirty again, so it's caught next frame
+        x1, y1, x2, y2 = rect
         s = self.scale
-        x *= s
-        y *= s
+        image = self.framebuffer.toImage((x1, y1, x2 - x1, y2 - y1))
         if s != 1:
-            self.canvas.create_rectangle(x, y, x+s-1, y+s-1, fill=rgb_str, outline=rgb_str)
-        else:
-            self.canvas.create_line(x, y, x + 1, y, fill=rgb_str)
+            image = image.resize((image.width * s, image.height * s), Image.NEAREST)
+
+        # Only the changed area is converted, and Tk copies it into place
+        region = ImageTk.PhotoImage(image)
+        self._screen_image.tk.call(self._screen_image, 'copy', region, '-to', x1 * s, y1 * s)
+
+    def _markDirty(self, damage):
+        with self._dirty_lock:
+            for x, y, w, h in damage:
+                if self._dirty_rect is None:
+                    self._dirty_rect = (x, y, x + w, y + h)
+                else:
+                    x1, y1, x2, y2 = self._dirty_rect
+                    self._dirty_rect = (min(x1, x), min(y1, y), max(x2, x + w), max(y2, y + h))
+
+    def sendTouch(self, x, y, z = 500):
+        '''Sends a touch at (x, y) in screen coordinates, like the touch panel does.'''
+        self._sendEvent(bytes([EVENT_ON_CTP_CHANGE, 1]) + EVENT_LAYOUT_TOUCH.pack(x, y, z))
+
+    def sendRelease(self):
+        '''Sends the end of a touch.'''
+        self._sendEvent(bytes([EVENT_ON_CTP_CHANGE, 0]))
+
+    def sendKey(self, key):
+        '''Sends a key press.  Keys are 16 bit codes, such as ord('a').'''
+        key &= 0xFFFF
+        self._sendEvent(bytes([EVENT_ON_KEYPRESS, key >> 8, key & 255]))
 
     # Input class callback
     def onDragStartCB(self, evt):
-        z = 500
-        x = evt.x // self.scale
-        y = evt.y // self.scale
-        self.output_buffer += bytes([EVENT_ON_CTP_CHANGE, 1,
-                                  x >> 8, x & 255,
-                                  y >> 8, y & 255,
-                                  z >> 8, z & 255,
-                              ])
+        self.sendTouch(evt.x // self.scale, evt.y // self.scale)
 
     def onDragPointCB(self, evt):
-        z = 500
-        x = evt.x // self.scale
-        y = evt.y // self.scale
-        self.output_buffer += bytes([EVENT_ON_CTP_CHANGE, 1,
-                                  x >> 8, x & 255,
-                                  y >> 8, y & 255,
-                                  z >> 8, z & 255,
-                              ])
+        self.sendTouch(evt.x // self.scale, evt.y // self.scale)
 
     def onDragStopCB(self, evt):
-        self.output_buffer += bytes([EVENT_ON_CTP_CHANGE, 0])
+        self.sendRelease()
+
+    def onKeyPressCB(self, evt):
+        if evt.char:
+            key = ord(evt.char)
+        else:
+            key = evt.keysym_num
+        self.sendKey(key)
+
+    def _sendEvent(self, data):
+        # Called from the Tk thread, so wake up anyone blocked in wait()
+        with self._output_ready:
+            self.output_buffer += data
+            self._output_ready.notify_all()
 
     def write(self, data):
+        # Simulate the time delay.  Each byte takes 10 bits on the wire.
+        time.sleep(len(data) * 10 / self.baud)
+
+        # A single write may hold several commands, and the last one may be incomplete
+        self.input_buffer += data
+        i = 0
+        while i < len(self.input_buffer):
+            size = getCommandSize(self.input_buffer, i)
+            if size is None or i + size > len(self.input_buffer):
+                # Wait for the rest of the command
+                break
+
+            self.runCommand(bytes(self.input_buffer[i:i + size]))
+            i += size
+
+        del self.input_buffer[:i]
+        self._drawn()
+
+    def _drawn(self):
+        # Damage is taken even when headless, so it doesn't pile up
+        damage = self.framebuffer.takeDamage()
+        if not self.headless:
+            self._markDirty(damage)
+
+    def runCommand(self, data):
         cmd = data[0]
 
-        # Simulate the time delay
-        #print(f"Delay: {len(data) / 11.520}ms")
-        time.sleep(len(data) / 11520)
-
-        if cmd == COMMAND_SET_TEXT_CURSOR:
-            x = (data[1] << 8) | data[2]
-            y = (data[3] << 8) | data[4]
-            self.text_cursor = (x, y)
-
-        elif cmd == COMMAND_WRITE_TEXT:
-            n = data[1]
-            x = self.text_cursor[0]
-            y = self.text_cursor[1]
-            for char in data[2:n + 2]:
-                if char == 10:
-                    # Newline
-                    x = 0
-                    y += 12
-                elif char == 32:
-                    # Space
-                    x += 8
-                else:
-                    ntios_font.draw_char_on_canvas(self, x, y, char, self.text_color)
-                    x += 8
-
-        elif cmd == COMMAND_SET_TEXT_COLOR:
-            rgb = u16_to_rgb((data[1] << 8) | data[2])
-            self.text_color = RGBtoStr(rgb)
-
-        elif cmd == COMMAND_FILL_RECT:
-            x1 = ((data[1] << 8) | data[2]) * self.scale
-            y1 = ((data[3] << 8) | data[4]) * self.scale
-            x2 = ((data[5] << 8) | data[6]) * self.scale
-            y2 = ((data[7] << 8) | data[8]) * self.scale
-            rgb = u16_to_rgb((data[9] << 9) | data[10])
-            rgb_str = RGBtoStr(rgb)
-            self.canvas.create_rectangle(x1, y1, x2, y2, fill=rgb_str, outline=rgb_str)
-
-        elif cmd == COMMAND_DRAW_RECT:
-            x1 = ((data[1] << 8) | data[2]) * self.scale
-            y1 = ((data[3] << 8) | data[4]) * self.scale
-            x2 = ((data[5] << 8) | data[6]) * self.scale
-            y2 = ((data[7] << 8) | data[8]) * self.scale
-            rgb = u16_to_rgb((data[9] << 8) | data[10])
-            rgb_str = RGBtoStr(rgb)
-            self.canvas.create_rectangle(x1, y1, x2, y2, outline=rgb_str)
-
-        elif cmd == COMMAND_DRAW_PIXEL:
-            x = (data[1] << 8) | data[2]
-            y = (data[3] << 8) | data[4]
-            color = (data[5] << 8) | data[6]
-            self.setPixel(x, y, color)
-
-        elif cmd == COMMAND_FILL_DISPLAY:
-            rgb = u16_to_rgb((data[1] << 8) | data[2])
-            rgb_str = RGBtoStr(rgb)
-            xs = self._canvas_width
-            ys = self._canvas_height
-            self.canvas.create_rectangle(0, 0, xs, ys, fill=rgb_str, outline=rgb_str)
-
-            # No images left, clear the image cache
-            self.imcache = []
-
-        elif cmd == COMMAND_WRITE_VRAM:
-            first_word = ((data[1] << 8) | data[2]) * 256
-
-            # Read a sector into VRAM
-            for i in range(256):
-                self.vram[first_word + i] = (data[i*2 + 3] << 8) | data[i*2 + 4]
-
-        elif cmd == COMMAND_DRAW_BITMAP:
-            first_word = ((data[1] << 8) | data[2]) * 256
-            x = ((data[3] << 8) | data[4]) * self.scale
-            y = ((data[5] << 8) | data[6]) * self.scale
-            width = data[7]
-            height = data[8]
-            self.drawBitmap16(x, y, width, height, first_word)
-
-        elif cmd == COMMAND_DRAW_PALETTE_IMAGE:
-            first_word = ((data[1] << 8) | data[2]) * 256
-            x = ((data[3] << 8) | data[4]) * self.scale
-            y = ((data[5] << 8) | data[6]) * self.scale
-            width = data[7]
-            height = data[8]
-            n_colors = data[9]
-            self.drawPaletteImage(x, y, width, height, first_word, n_colors)
+        if cmd == COMMAND_REQUEST_ACKNOWLEDGE:
+            self._sendEvent(bytes([EVENT_ACKNOWLEDGE]))
 
-    def available(self):
-        return len(self.output_buffer) > 0
+        elif cmd == COMMAND_SET_BAUD:
+            # Acknowledge at the old rate, then switch.  The emulated link always works, so
+            # the host's check at the new rate always succeeds.
+            self._sendEvent(bytes([EVENT_ACKNOWLEDGE]))
+            self.baud = (data[1] << 24) | (data[2] << 16) | (data[3] << 8) | data[4]
 
-    def drawBitmap16(self, xp, yp, width, height, first_word):
+        elif cmd == COMMAND_SET_VIBRATE:
+            # Nothing to shake
+            pass
 
-        # Create Image
-        pilImage = Image.new(mode="RGB", size=(width, height))
-        for y in range(height):
-            for x in range(width):
-                color = u16_to_rgb(self.vram[first_word + x + y*width])
-                pilImage.putpixel((x, y), color)
-
-        pilImage = pilImage.resize((width * self.scale, height * self.scale))
+        else:
+            # Everything else draws
+            self.framebuffer.runCommand(data)
 
-        # Apply to Canvas
-        self.imcache.append(ImageTk.PhotoImage(pilImage))
-        self.canvas.create_image((xp, yp), image=self.imcache[-1], anchor='nw')
+    def setBaud(self, baud):
+        # The host end of the emulated link follows the tablet's rate by itself
+        pass
 
-    def drawPaletteImage(self, xp, yp, width, height, first_word, n_colors):
+    def available(self):
+        return len(self.output_buffer) > 0
 
-        # Create Image
-        pilImage = Image.new(mode="P", size=(width, height))
-        palette = []
-        for i in range(n_colors):
-            palette += u16_to_rgb(self.vram[first_word + i])
-        pilImage.putpalette(palette + [0]*(768 - len(palette)))
-        for y in range(height):
-            for x in range(0, width, 4):
-                pixel_data = self.vram[n_colors + first_word + ((x + y*width) // 4)]
-                pilImage.putpixel((x + 0, y), (pixel_data >> 12) & 15)
-                pilImage.putpixel((x + 1, y), (pixel_data >> 8) & 15)
-                pilImage.putpixel((x + 2, y), (pixel_data >> 4) & 15)
-                pilImage.putpixel((x + 3, y), (pixel_data >> 0) & 15)
+    def wait(self, timeout = None):
+        '''Blocks until there are events to read, or timeout seconds pass.  Returns available().'''
+        with self._output_ready:
+            return self._output_ready.wait_for(self.available, timeout)
 
-        pilImage = pilImage.resize((width * self.scale, height * self.scale))
+    def drawBitmap16(self, x, y, width, height, first_word):
+        '''Draws an RGB565 bitmap straight from VRAM, without going through the link.'''
+        self.framebuffer.drawBitmap(x, y, width, height, first_word)
+        self._drawn()
 
-        # Apply to Canvas
-        self.imcache.append(ImageTk.PhotoImage(pilImage))
-        self.canvas.create_image((xp, yp), image=self.imcache[-1], anchor='nw')
+    def drawPaletteImage(self, x, y, width, height, first_word, n_colors):
+        '''Draws a palette image straight from VRAM, without going through the link.'''
+        self.framebuffer.drawPaletteImage(x, y, width, height, first_word, n_colors)
+        self._drawn()
 
     def read(self):
-        data = self.output_buffer
-        self.output_buffer = b''
+        with self._output_ready:
+            data = self.output_buffer
+            self.output_buffer = b''
         return data
 
@@ -1,3 +1,4 @@
+import inspect
 import math
 import os
 import time
@@ -6,7 +7,8 @@ from typing import List
 
 from PIL import Image
 
-from utils.protocol import TabletInterface, TabletDisplay
+from utils.async_protocol import AsyncTabletInterface
+from utils.protocol import TabletInterface, TabletDisplay, rectsIntersect
 from utils.stringutil import splitlines
 from utils.parsemd import parseMarkdown, MarkdownParagraphElement, MarkdownImageElement, MarkdownHeaderElement
 
@@ -71,9 +73,12 @@ class PopupBox:
         button_bottom = top + self.height
         button_top = button_bottom - self.BUTTON_HEIGHT
 
-        self.draw(display)
+        with tablet.frame():
+            self.draw(display)
+
         while True:
-            time.sleep(0.010)
+            # Also sends the popup, in case we're nested inside another frame
+            tablet.waitEvent()
             for point in tablet.getPresses():
                 x = point[0]
                 y = point[1]
@@ -84,7 +89,7 @@ class PopupBox:
 
                     # Now we need to wait for the press to end, otherwise the next program will get a press
                     while len(tablet.getPresses()) > 0:
-                        time.sleep(0.010)
+                        tablet.waitEvent()
 
                     return self.buttons[button_id]
 
@@ -106,6 +111,21 @@ class UIElement:
         self.x = x
         self.y = y
 
+        # Set by the ApplicationWindow this element is added to
+        self.window = None
+
+    def getBounds(self):
+        """
+        Returns the (x, y, width, height) rectangle the element draws in, relative to the window.
+        None means the element doesn't know, and will be redrawn along with anything else.
+        """
+        return None
+
+    def invalidate(self):
+        """Asks the window to redraw this element the next time it redraws"""
+        if self.window is not None:
+            self.window.invalidate(self.getBounds())
+
     def update(self):
         pass
 
@@ -131,13 +151,23 @@ class ApplicationWindow:
     # for it to count as a click.  Otherwise it becomes a drag.  Measured in seconds.
     PRESS_CLICK_TIME_CUTOFF = 0.5
 
-    def __init__(self, elements: List[UIElement]):
+    # Once this many separate areas need redrawing, they're merged into one
+    MAX_DIRTY_RECTS = 8
+
+    def __init__(self, elements: List[UIElement], bgcolor=0x000000):
         self.elements = elements
+        self.bgcolor = bgcolor
         self.keepRunningMainLoop = False
         self.pressTimer = 0
         self.wasPressed = False
         self.lastPress = None
 
+        # Areas that have changed since the last redraw, or None for the whole screen
+        self.dirtyRects = []
+
+        for i in self.elements:
+            i.window = self
+
     def update(self):
         for i in self.elements:
             i.update()
@@ -146,49 +176,116 @@ class ApplicationWindow:
         for i in self.elements:
             i.render(display, 0, 0)
 
+    def invalidate(self, rect=None):
+        """Marks an (x, y, width, height) area as needing a redraw.  The default is the whole screen."""
+        if rect is None:
+            self.dirtyRects = None
+        elif self.dirtyRects is not None:
+            self.dirtyRects.append(rect)
+            if len(self.dirtyRects) > self.MAX_DIRTY_RECTS:
+                left = min(r[0] for r in self.dirtyRects)
+                top = min(r[1] for r in self.dirtyRects)
+                right = max(r[0] + r[2] for r in self.dirtyRects)
+                bottom = max(r[1] + r[3] for r in self.dirtyRects)
+                self.dirtyRects = [(left, top, right - left, bottom - top)]
+
+    def redraw(self, display: TabletDisplay):
+        """
+        Redraws whatever has been invalidated since the last redraw.  Each dirty area is cleared
+        to the background color, then every element that overlaps it is rendered again.
+        """
+        if self.dirtyRects is None:
+            display.fillScreen(self.bgcolor)
+            self.render(display)
+        else:
+            for rect in self.dirtyRects:
+                display.fillRect(rect[0], rect[1], rect[2], rect[3], self.bgcolor)
+                for i in self.elements:
+                    bounds = i.getBounds()
+                    if bounds is None or rectsIntersect(bounds, rect):
+                        i.render(display, 0, 0)
+
+        self.dirtyRects = []
+
+    def handlePresses(self, presses):
+        """
+        Dispatches the current touch state to the elements.  Returns whatever the elements'
+        onClick handlers returned, so that run() can await coroutine callbacks.
+        """
+        results = []
+        if len(presses) == 1:
+            press = presses[0]
+            if not self.wasPressed:
+                self.wasPressed = True
+                self.lastPress = press
+                self.pressTimer = time.time()
+                for i in self.elements:
+                    i.onPress(self.lastPress[0], self.lastPress[1])
+
+            elif self.pressTimer + self.PRESS_CLICK_TIME_CUTOFF < time.time():
+                # Dragging the cursor
+                for i in self.elements:
+                    i.onDrag(self.lastPress[0], self.lastPress[1], press[0], press[1])
+                self.lastPress = press
+
+        elif len(presses) == 0:
+            # Unpress
+            if self.lastPress is not None:
+                for i in self.elements:
+                    i.onRelease(self.lastPress[0], self.lastPress[1])
+                if self.wasPressed and self.pressTimer + self.PRESS_CLICK_TIME_CUTOFF > time.time():
+                    # Click
+                    for i in self.elements:
+                        results.append(i.onClick(self.lastPress[0], self.lastPress[1]))
+
+            self.wasPressed = False
+
+        else:
+            # Multitouch
+            self.wasPressed = False
+            for point in presses:
+                x = point[0]
+                y = point[1]
+
+                # What do we do with multitouch?
+
+        return results
+
     def mainloop(self, tablet: TabletInterface):
         display = tablet.getDisplay()
-        self.render(display)
+        with tablet.frame():
+            self.render(display)
 
         self.keepRunningMainLoop = True
         while self.keepRunningMainLoop:
-            time.sleep(0.010)
-            presses = tablet.getPresses()
-            if len(presses) == 1:
-                press = presses[0]
-                if not self.wasPressed:
-                    self.wasPressed = True
-                    self.lastPress = press
-                    self.pressTimer = time.time()
-                    for i in self.elements:
-                        i.onPress(self.lastPress[0], self.lastPress[1])
-
-                elif self.pressTimer + self.PRESS_CLICK_TIME_CUTOFF < time.time():
-                    # Dragging the cursor
-                    for i in self.elements:
-                        i.onDrag(self.lastPress[0], self.lastPress[1], press[0], press[1])
-                    self.lastPress = press
-
-            elif len(presses) == 0:
-                # Unpress
-                if self.lastPress is not None:
-                    for i in self.elements:
-                        i.onRelease(self.lastPress[0], self.lastPress[1])
-                    if self.wasPressed and self.pressTimer + self.PRESS_CLICK_TIME_CUTOFF > time.time():
-                        # Click
-                        for i in self.elements:
-                            i.onClick(self.lastPress[0], self.lastPress[1])
+            # Sends everything drawn so far, even if this loop runs inside another frame, and
+            # then sleeps until there's input to handle
+            tablet.waitEvent()
+            with tablet.frame():
+                self.handlePresses(tablet.getPresses())
+                self.redraw(display)
+
+    async def run(self, tablet: AsyncTabletInterface):
+        """
+        The asyncio version of mainloop.  Callbacks may be coroutine functions, which are
+        awaited, and other tasks keep running while the window waits for input.
+        """
+        display = tablet.getDisplay()
+        with tablet.frame():
+            self.render(display)
 
-                self.wasPressed = False
+        self.keepRunningMainLoop = True
+        while self.keepRunningMainLoop:
+            await tablet.nextEvent()
+            with tablet.frame():
+                results = self.handlePresses(tablet.getPresses())
 
-            else:
-                # Multitouch
-                self.wasPressed = False
-                for point in presses:
-                    x = point[0]
-                    y = point[1]
+            for result in results:
+                if inspect.isawaitable(result):
+                    await result
 
-                    # What do we do with multitouch?
+            with tablet.frame():
+                self.redraw(display)
 
     def stopMainLoop(self):
         """
@@ -215,25 +312,25 @@ class TextButtonElement(UIElement):
         self.text = text
         self.textColor = textColor
         self.cb = callback
+        self.pressed = False
+
+    def getBounds(self):
+        return (self.x, self.y, self.width, self.height)
 
     def onPress(self, x, y):
         # Don't process the event if it's not in this button
         if x < self.x or y < self.y or x > self.x + self.width or y > self.y + self.height:
             return
 
-        if self.pressColor is not None and self.display is not None:
-            self.display.fillRect(self.x, self.y, self.width, self.height, self.pressColor)
-            self.display.setCursor(self.x + self.xPad, self.y + self.yPad)
-            self.display.setTextColor(self.textColor)
-            self.display.writeText(self.text)
+        if self.pressColor is not None:
+            self.pressed = True
+            self.invalidate()
 
     def onRelease(self, x, y):
-        # Don't process the event if it's not in this button
-        if x < self.x or y < self.y or x > self.x + self.width or y > self.y + self.height:
-            return
-
-        if self.pressColor is not None and self.display is not None:
-            self.render(self.display, 0, 0)
+        # The press may have been dragged off the button, so this doesn't check the position
+        if self.pressed:
+            self.pressed = False
+            self.invalidate()
 
     def onClick(self, x, y):
         # Don't process the event if it's not in this button
@@ -241,13 +338,16 @@ class TextButtonElement(UIElement):
             return
 
         if self.cb is not None:
-            self.cb(self)
+            return self.cb(self)
 
     def render(self, display: TabletDisplay, x, y):
         """x and y arguments are the location of the upper-left corner of the window"""
         self.display = display
 
-        display.fillRect(self.x, self.y, self.width, self.height, self.color)
+        if self.pressed:
+            display.fillRect(self.x, self.y, self.width, self.height, self.pressColor)
+        else:
+            display.fillRect(self.x, self.y, self.width, self.height, self.color)
         display.setCursor(self.x + self.xPad, self.y + self.yPad)
         display.setTextColor(self.textColor)
         display.writeText(self.text)
@@ -272,18 +372,23 @@ class IconButtonElement(UIElement):
         text = text.strip()
 
         # Now we need to intelligently split the characters.
-        num_chars_per_line = math.floor((self.width - self.TEXT_X_PAD*2) / 8)
-        self.text = splitlines(text, ' ', num_chars_per_line)
+        self.label = text
+        self.charsPerLine = math.floor((self.width - self.TEXT_X_PAD*2) / 8)
+        self.text = splitlines(text, ' ', self.charsPerLine)
 
         self.height += 12 * len(self.text)
 
+    def getBounds(self):
+        # The text is drawn under self.height
+        return (self.x, self.y, self.width, self.height + self.TEXT_Y_PAD + 12 * len(self.text))
+
     def onClick(self, x, y):
         # Don't process the event if it's not in this button
         if x < self.x or y < self.y or x > self.x + self.width or y > self.y + self.height:
             return
 
         if self.cb is not None:
-            self.cb(self)
+            return self.cb(self)
 
     def render(self, display: TabletDisplay, x, y):
         """x and y arguments are the location of the upper-left corner of the window"""
@@ -292,11 +397,8 @@ class IconButtonElement(UIElement):
         y += self.y
 
         display.drawImage(x, y, self.icon)
-        for i in range(len(self.text)):
-            line = self.text[i]
-            display.setCursor(x + self.TEXT_X_PAD, y + self.height + self.TEXT_Y_PAD + i*12)
-            display.setTextColor(self.textColor)
-            display.writeText(line)
+        display.writeTextBlock(x + self.TEXT_X_PAD, y + self.height + self.TEXT_Y_PAD,
+                               self.label, self.charsPerLine, self.textColor)
 
 
 class MarkdownElement(UIElement):
@@ -307,6 +409,9 @@ class MarkdownElement(UIElement):
         self.markdown_li = parseMarkdown(markdown)
         self.root = root
 
+    def getBounds(self):
+        return (self.x, self.y, self.width, self.height)
+
     def render(self, display: TabletDisplay, x, y):
         x += self.x
         y += self.y + 16
@@ -328,9 +433,5 @@ class MarkdownElement(UIElement):
                     display.writeText('Image of ' + i.desc)
                     y += 16
             elif isinstance(i, MarkdownParagraphElement):
-                display.setTextColor(0xD0D0D0)
-                for line in splitlines(i.text, ' ', math.floor(self.width / 8) - 4):
-                    display.setCursor(x + 32, y)
-                    display.writeText(line)
-                    y += 12
-                y += 4
+                num_lines = display.writeTextBlock(x + 32, y, i.text, math.floor(self.width / 8) - 4, 0xD0D0D0)
+                y += 12 * num_lines + 4
@@ -0,0 +1,154 @@
+import asyncio
+import concurrent.futures
+import threading
+
+from utils.protocol import TabletInterface
+
+
+class AsyncTabletInterface(TabletInterface):
+    '''
+    A TabletInterface for code running in an asyncio event loop.
+
+    Writes are handed to a dedicated writer thread, so encoding and drawing can carry on
+    while earlier commands are still going out over the link, and drain() can be awaited
+    to wait for them.  Input is read as soon as the loop sees the stream become readable,
+    and nextEvent() can be awaited instead of blocking in waitEvent().
+
+    The blocking methods still work, so old style nested mainloops can be called from a
+    coroutine, but they stall the event loop while they run.
+    '''
+
+    # How long a stream without a file descriptor is waited on at a time in the background
+    STREAM_POLL_TIMEOUT = 0.5
+
+    def __init__(self, stream):
+        super().__init__(stream)
+        self._input_event = None
+        self._reader_loop = None
+        self._loop_thread = None
+        self._reader_task = None
+
+        # All writes go through one thread, so they reach the stream in order
+        self._writer = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self._write_lock = threading.Lock()
+        self._queued_output = bytearray()
+        self._queued_command_ends = []
+        self._write_job = None
+
+    def flush(self):
+        '''Queues the buffered commands for the writer thread without waiting for them.'''
+        if len(self._encoder) == 0:
+            return
+
+        with self._write_lock:
+            with memoryview(self._encoder.buffer) as view, view[:len(self._encoder)] as data:
+                if self.mirror is not None:
+                    self.mirror.write(data)
+                offset = len(self._queued_output)
+                self._queued_command_ends += [offset + end for end in self._encoder.command_ends]
+                self._queued_output += data
+            self._encoder.clear()
+
+            # Anything queued while a write is in progress goes out with the next write
+            if self._write_job is None:
+                self._write_job = self._writer.submit(self._writeQueued)
+
+    def _writeQueued(self):
+        while True:
+            with self._write_lock:
+                if len(self._queued_output) == 0:
+                    self._write_job = None
+                    return
+
+                data = bytes(self._queued_output)
+                command_ends = self._queued_command_ends
+                self._queued_output.clear()
+                self._queued_command_ends = []
+
+            self._transmit(data, command_ends)
+
+    async def drain(self):
+        '''Flushes, then waits until everything drawn so far has been written to the stream.'''
+        self.flush()
+        job = self._write_job
+        while job is not None:
+            await asyncio.wrap_future(job)
+            job = self._write_job
+
+    def _waitWritten(self):
+        self.flush()
+        job = self._write_job
+        while job is not None:
+            job.result()
+            job = self._write_job
+
+    def waitEvent(self, timeout = None):
+        # The writer thread has to finish first, or we could sleep with output still queued
+        self._waitWritten()
+        return self.stream.wait(timeout)
+
+    async def nextEvent(self, timeout = None):
+        '''
+        Sends anything buffered, then waits until the tablet sends input or timeout seconds
+        pass.  A timeout of None waits forever.  Returns True if input arrived.
+        '''
+        self.flush()
+        self._startReader()
+
+        # The writer thread may have read input while waiting for room to send
+        if not self._takeInputReceived():
+            try:
+                await asyncio.wait_for(self._input_event.wait(), timeout)
+            except asyncio.TimeoutError:
+                return False
+
+        self._input_event.clear()
+        self._takeInputReceived()
+        return True
+
+    def _startReader(self):
+        loop = asyncio.get_running_loop()
+        if self._reader_loop is loop:
+            return
+
+        # Events belong to a loop on older versions of Python, so make one for this loop
+        self._reader_loop = loop
+        self._loop_thread = threading.get_ident()
+        self._input_event = asyncio.Event()
+        if hasattr(self.stream, 'fileno'):
+            loop.add_reader(self.stream.fileno(), self._onInput)
+        else:
+            # The emulator has no file descriptor, so wait on it in a worker thread instead
+            self._reader_task = loop.create_task(self._pollStream())
+
+    async def _pollStream(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            if await loop.run_in_executor(None, self.stream.wait, self.STREAM_POLL_TIMEOUT):
+                self._onInput()
+
+    def _onInput(self):
+        self._update()
+        self._input_event.set()
+
+    def _update(self):
+        super()._update()
+
+        # Input read by another thread, like the writer, has to wake up nextEvent() too.  The
+        # loop's own thread doesn't need to, since nextEvent() checks before it waits.
+        loop = self._reader_loop
+        if self._input_received and loop is not None and threading.get_ident() != self._loop_thread and not loop.is_closed():
+            loop.call_soon_threadsafe(self._input_event.set)
+
+    def close(self):
+        '''Stops reading input and shuts down the writer thread once queued output is sent.'''
+        if self._reader_loop is not None:
+            if self._reader_task is not None:
+                self._reader_task.cancel()
+                self._reader_task = None
+            elif not self._reader_loop.is_closed():
+                self._reader_loop.remove_reader(self.stream.fileno())
+            self._reader_loop = None
+
+        self._waitWritten()
+        self._writer.shutdown()
@@ -4,3 +4,81 @@ from PIL import Image
 def compressToPaletteImage(image):
     return image.convert("P", palette=Image.ADAPTIVE, colors=16)
     
+
+# Run-length encoding of VRAM sectors, as used by COMMAND_WRITE_VRAM_RLE.  The data is a
+# series of chunks of big-endian 16-bit words, each starting with a control byte:
+#  - If the high bit is set, the next word is repeated (control & 0x7F) + 1 times.
+#  - Otherwise (control + 1) words follow as they are.
+# Anything left of the sector after the last chunk is filled with zeros.
+RLE_MAX_CHUNK = 128
+
+
+def rleEncodeWords(data):
+    '''
+    Compresses big-endian 16-bit words (any bytes-like object) into the chunks described
+    above.  An odd last byte is padded with zero, and trailing zero words are left out.
+    '''
+    data = bytes(data)
+    if len(data) % 2:
+        data += b'\0'
+    words = [data[i:i + 2] for i in range(0, len(data), 2)]
+
+    # The decoder fills in trailing zeros
+    end = len(words)
+    while end > 0 and words[end - 1] == b'\0\0':
+        end -= 1
+
+    out = bytearray()
+    literal_start = 0
+    i = 0
+    while i < end:
+        run_end = i + 1
+        while run_end < end and run_end - i < RLE_MAX_CHUNK and words[run_end] == words[i]:
+            run_end += 1
+
+        # A run of two costs the same as two literal words, and usually saves a control byte
+        if run_end - i < 2:
+            i += 1
+            continue
+
+        _rleAddLiterals(out, words, literal_start, i)
+        out.append(0x80 | (run_end - i - 1))
+        out += words[i]
+        i = run_end
+        literal_start = i
+
+    _rleAddLiterals(out, words, literal_start, end)
+    return bytes(out)
+
+
+def _rleAddLiterals(out, words, start, end):
+    for chunk_start in range(start, end, RLE_MAX_CHUNK):
+        chunk_end = min(chunk_start + RLE_MAX_CHUNK, end)
+        out.append(chunk_end - chunk_start - 1)
+        out += b''.join(words[chunk_start:chunk_end])
+
+
+def rleDecodeWords(data, num_words = 256):
+    '''
+    Expands data from rleEncodeWords() into num_words big-endian words, the same way the
+    firmware does.  Output past num_words is dropped, and a truncated chunk ends the data.
+    '''
+    out = bytearray()
+    size = num_words * 2
+    i = 0
+    while i < len(data) and len(out) < size:
+        control = data[i]
+        count = (control & 0x7F) + 1
+        i += 1
+        if control & 0x80:
+            if len(data) - i < 2:
+                break
+            out += bytes(data[i:i + 2]) * count
+            i += 2
+        else:
+            count = min(count, (len(data) - i) // 2)
+            out += data[i:i + count * 2]
+            i += count * 2
+
+    del out[size:]
+    return bytes(out) + bytes(size - len(out))
@@ -0,0 +1,101 @@
+import os
+
+
+class PayloadCache:
+    '''
+    A directory of encoded VRAM payloads, one file per payload, named after the content
+    hash of the image it was encoded from.  Entries survive restarts, so an image only
+    has to be encoded the first time it is ever drawn.
+
+    The directory is kept under max_size bytes by deleting the entries that were used
+    least recently, so it doesn't fill up the disk.
+    '''
+
+    # Bump this whenever a payload encoding changes, so old files are ignored
+    VERSION = 1
+
+    # Default limit on the bytes kept in the directory
+    MAX_SIZE = 32 * 1024 * 1024
+
+    def __init__(self, directory, max_size = MAX_SIZE):
+        self.directory = directory
+        self.max_size = max_size
+
+        # Bytes in the directory, counted on the first write
+        self._size = None
+
+    def _getPath(self, key):
+        return os.path.join(self.directory, f'{key}.v{self.VERSION}.bin')
+
+    def get(self, key):
+        '''Returns the payload stored under key, or None if there isn't one.'''
+        path = self._getPath(key)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+        except OSError:
+            return None
+
+        # Entries are pruned oldest first, so mark this one as recently used
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return data
+
+    def put(self, key, data):
+        '''Stores a payload under key.  The cache is best-effort, so write errors are ignored.'''
+        path = self._getPath(key)
+        temp_path = f'{path}.{os.getpid()}.tmp'
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            with open(temp_path, 'wb') as f:
+                f.write(data)
+
+            # Readers only ever see complete files
+            os.replace(temp_path, path)
+        except OSError:
+            try:
+                os.remove(temp_path)
+            except OSError:
+                pass
+            return
+
+        if self._size is None:
+            self._size = sum(size for _, size, _ in self._listEntries())
+        else:
+            self._size += len(data)
+
+        if self._size > self.max_size:
+            self._prune()
+
+    def _listEntries(self):
+        '''Returns (mtime, size, path) for every file in the directory.'''
+        entries = []
+        try:
+            with os.scandir(self.directory) as it:
+                for entry in it:
+                    try:
+                        if entry.is_file():
+                            stat = entry.stat()
+                            entries.append((stat.st_mtime, stat.st_size, entry.path))
+                    except OSError:
+                        pass
+        except OSError:
+            pass
+        return entries
+
+    def _prune(self):
+        # Go well under the limit, so the directory isn't scanned again on every write
+        entries = sorted(self._listEntries())
+        size = sum(size for _, size, _ in entries)
+        for _, entry_size, path in entries:
+            if size <= self.max_size * 3 // 4:
+                break
+            try:
+                os.remove(path)
+                size -= entry_size
+            except OSError:
+                pass
+
+        self._size = size
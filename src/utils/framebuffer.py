@@ -0,0 +1,201 @@
+import numpy as np
+from PIL import Image
+
+from simulator.ntios_font import CHAR_HEIGHT, CHAR_WIDTH, text_mask
+from utils.compression import rleDecodeWords
+from utils.protocol import *
+from utils.stringutil import splitlines
+
+
+def u16_to_rgb_array(pixels):
+    '''Expands an array of RGB565 words to an array of 8-bit (red, green, blue) triples.'''
+    rgb = np.empty(pixels.shape + (3,), dtype=np.uint8)
+    rgb[..., 0] = (pixels >> 8) & 0xF8
+    rgb[..., 1] = (pixels >> 3) & 0xFC
+    rgb[..., 2] = (pixels << 3) & 0xFF
+    return rgb
+
+
+class Framebuffer:
+    '''
+    A copy of the display's contents, kept by running the same command stream the tablet
+    gets.  Write commands to it with write(), exactly as they would be sent to the tablet.
+
+    Pixels are kept as RGB565 words in pixels, indexed [y, x].  Every area whose pixels
+    were actually changed by a command is recorded, and can be collected with takeDamage().
+    '''
+
+    def __init__(self, width = 800, height = 480, vram_sectors = 1024):
+        self.width = width
+        self.height = height
+        self.pixels = np.zeros((height, width), dtype=np.uint16)
+        self.vram = np.zeros(vram_sectors * VRAM_SECTOR_WORDS, dtype=np.uint16)
+        self.text_cursor = (0, 0)
+        self.text_color = 0xFFFF
+        self.damage = []
+        self._input_buffer = bytearray()
+
+    def write(self, data):
+        '''Runs a chunk of the command stream.  Commands may be split between writes.'''
+        self._input_buffer += data
+        buf = self._input_buffer
+        i = 0
+        while i < len(buf):
+            size = getCommandSize(buf, i)
+            if size is None or i + size > len(buf):
+                # Wait for the rest of the command
+                break
+
+            self.runCommand(memoryview(buf)[i:i + size].tobytes())
+            i += size
+
+        del buf[:i]
+
+    def runCommand(self, data):
+        '''Runs a single complete command.'''
+        cmd = data[0]
+
+        if cmd == COMMAND_SET_TEXT_CURSOR:
+            _, x, y = CMD_LAYOUT_SET_TEXT_CURSOR.unpack(data)
+            self.text_cursor = (x, y)
+
+        elif cmd == COMMAND_WRITE_TEXT:
+            self.drawText(data[2:])
+
+        elif cmd == COMMAND_WRITE_TEXT_BLOCK:
+            _, x, y, line_height, chars_per_line, c, _ = CMD_LAYOUT_WRITE_TEXT_BLOCK.unpack_from(data)
+            self.text_color = c
+            for line in splitlines(data[CMD_LAYOUT_WRITE_TEXT_BLOCK.size:], ord(' '), chars_per_line):
+                self.text_cursor = (x, y)
+                self.drawText(line)
+                y += line_height
+
+        elif cmd == COMMAND_SET_TEXT_COLOR:
+            self.text_color = CMD_LAYOUT_COLOR.unpack(data)[1]
+
+        elif cmd == COMMAND_DRAW_PIXEL:
+            _, x, y, c = CMD_LAYOUT_DRAW_PIXEL.unpack(data)
+            self._blit(x, y, np.full((1, 1), c, dtype=np.uint16))
+
+        elif cmd == COMMAND_FILL_RECT:
+            # Both corners are inclusive
+            _, x1, y1, x2, y2, c = CMD_LAYOUT_RECT.unpack(data)
+            if x2 >= x1 and y2 >= y1:
+                self._blit(x1, y1, np.full((y2 - y1 + 1, x2 - x1 + 1), c, dtype=np.uint16))
+
+        elif cmd == COMMAND_DRAW_RECT:
+            _, x1, y1, x2, y2, c = CMD_LAYOUT_RECT.unpack(data)
+            if x2 >= x1 and y2 >= y1:
+                mask = np.ones((y2 - y1 + 1, x2 - x1 + 1), dtype=bool)
+                mask[1:-1, 1:-1] = False
+                self._blit(x1, y1, np.full(mask.shape, c, dtype=np.uint16), mask)
+
+        elif cmd == COMMAND_FILL_DISPLAY:
+            self._blit(0, 0, np.full(self.pixels.shape, CMD_LAYOUT_COLOR.unpack(data)[1], dtype=np.uint16))
+
+        elif cmd == COMMAND_WRITE_VRAM:
+            first_word = CMD_LAYOUT_WRITE_VRAM.unpack_from(data)[1] * VRAM_SECTOR_WORDS
+            words = np.frombuffer(data, dtype='>u2', offset=CMD_LAYOUT_WRITE_VRAM.size)
+            self._writeVRAM(first_word, words)
+
+        elif cmd == COMMAND_WRITE_VRAM_RLE:
+            first_word = CMD_LAYOUT_WRITE_VRAM_RLE.unpack_from(data)[1] * VRAM_SECTOR_WORDS
+            words = rleDecodeWords(data[CMD_LAYOUT_WRITE_VRAM_RLE.size:])
+            self._writeVRAM(first_word, np.frombuffer(words, dtype='>u2'))
+
+        elif cmd == COMMAND_WRITE_VRAM_RANGE:
+            first_word = CMD_LAYOUT_WRITE_VRAM_RANGE.unpack_from(data)[1]
+            self._writeVRAM(first_word, np.frombuffer(data, dtype='>u2', offset=CMD_LAYOUT_WRITE_VRAM_RANGE.size))
+
+        elif cmd == COMMAND_DRAW_BITMAP:
+            _, sector, x, y, w, h = CMD_LAYOUT_DRAW_BITMAP.unpack(data)
+            self.drawBitmap(x, y, w, h, sector * VRAM_SECTOR_WORDS)
+
+        elif cmd == COMMAND_DRAW_PALETTE_IMAGE:
+            _, sector, x, y, w, h, n_colors = CMD_LAYOUT_DRAW_PALETTE_IMAGE.unpack(data)
+            self.drawPaletteImage(x, y, w, h, sector * VRAM_SECTOR_WORDS, n_colors)
+
+    def drawText(self, text):
+        '''Draws text at the text cursor and moves the cursor past it, like WRITE_TEXT.'''
+        x, y = self.text_cursor
+        for i, line in enumerate(bytes(text).split(b'\n')):
+            if i > 0:
+                x = 0
+                y += CHAR_HEIGHT
+
+            # Each line is stamped in one go
+            if len(line) > 0:
+                mask = text_mask(line)
+                self._blit(x, y, np.full(mask.shape, self.text_color, dtype=np.uint16), mask)
+                x += len(line) * CHAR_WIDTH
+
+        self.text_cursor = (x, y)
+
+    def drawBitmap(self, x, y, w, h, first_word):
+        '''Draws w * h RGB565 words from VRAM, starting at first_word, like DRAW_BITMAP.'''
+        # A view of VRAM, so nothing is copied until it's drawn
+        self._blit(x, y, self._readVRAM(first_word, w * h).reshape((h, w)))
+
+    def drawPaletteImage(self, x, y, w, h, first_word, n_colors):
+        '''Draws a 4 bit palette image from VRAM, starting at first_word, like DRAW_PALETTE_IMAGE.'''
+        self._blit(x, y, self._decodePaletteImage(first_word, w, h, n_colors))
+
+    def _decodePaletteImage(self, first_word, w, h, n_colors):
+        # The firmware looks up all 16 indices in the palette, even past n_colors
+        palette = self._readVRAM(first_word, 16)
+
+        words_per_row = (w + 3) // 4
+        words = self._readVRAM(first_word + n_colors, words_per_row * h).reshape((h, words_per_row))
+        indices = (words[:, :, None] >> np.array([12, 8, 4, 0], dtype=np.uint16)) & 15
+        return palette[indices.reshape((h, words_per_row * 4))[:, :w]]
+
+    def _readVRAM(self, first_word, n):
+        # Reads past the end of VRAM give zeros
+        words = self.vram[first_word:first_word + n]
+        if len(words) < n:
+            words = np.concatenate((words, np.zeros(n - len(words), dtype=np.uint16)))
+        return words
+
+    def _writeVRAM(self, first_word, words):
+        words = words[:max(len(self.vram) - first_word, 0)]
+        self.vram[first_word:first_word + len(words)] = words
+
+    def _blit(self, x, y, src, mask = None):
+        '''Draws src at (x, y), clipped to the screen, and records what changed.'''
+        h = min(src.shape[0], self.height - y)
+        w = min(src.shape[1], self.width - x)
+        if w <= 0 or h <= 0:
+            return
+
+        src = src[:h, :w]
+        dest = self.pixels[y:y + h, x:x + w]
+        changed = dest != src
+        if mask is not None:
+            changed &= mask[:h, :w]
+
+        rows = np.flatnonzero(changed.any(axis=1))
+        if len(rows) == 0:
+            return
+
+        cols = np.flatnonzero(changed.any(axis=0))
+        self.damage.append((x + int(cols[0]), y + int(rows[0]), int(cols[-1] - cols[0]) + 1, int(rows[-1] - rows[0]) + 1))
+        dest[changed] = src[changed]
+
+    def takeDamage(self):
+        '''Returns the (x, y, width, height) areas changed since the last call, oldest first.'''
+        damage = self.damage
+        self.damage = []
+        return damage
+
+    def getPixel(self, x, y):
+        '''Returns the RGB565 color of a pixel.'''
+        return int(self.pixels[y, x])
+
+    def toImage(self, rect = None):
+        '''Returns the screen, or an (x, y, width, height) area of it, as an RGB PIL image.'''
+        pixels = self.pixels
+        if rect is not None:
+            x, y, w, h = rect
+            pixels = pixels[y:y + h, x:x + w]
+
+        return Image.fromarray(u16_to_rgb_array(pixels), 'RGB')
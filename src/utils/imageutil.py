@@ -0,0 +1,75 @@
+import hashlib
+
+from PIL import Image, ImageChops
+
+# Lookup tables that pick out each channel's share of the high and low bytes of an
+# RGB565 word.  The bits of the two shares never overlap, so adding them is an OR.
+_RED_TO_HIGH = [c & 0xF8 for c in range(256)]
+_GREEN_TO_HIGH = [c >> 5 for c in range(256)]
+_GREEN_TO_LOW = [(c << 3) & 0xE0 for c in range(256)]
+_BLUE_TO_LOW = [c >> 3 for c in range(256)]
+
+
+def image_to_rgb565(image):
+    '''
+    Converts a whole image to big-endian RGB565 words, returned as bytes in row-major
+    order.  This is the same conversion as protocol.rgb_to_u16, done by PIL in one pass.
+    '''
+    red, green, blue = image.convert('RGB').split()
+    high = ImageChops.add(red.point(_RED_TO_HIGH), green.point(_GREEN_TO_HIGH))
+    low = ImageChops.add(green.point(_GREEN_TO_LOW), blue.point(_BLUE_TO_LOW))
+
+    # LA is the only two-channel mode, and packs the channels as byte pairs
+    return Image.merge('LA', (high, low)).tobytes()
+
+
+def palette_image_to_4bpp(image):
+    '''
+    Packs a palette ('P' mode) image of up to 16 colors for COMMAND_DRAW_PALETTE_IMAGE.
+
+    Returns (palette_size, data), where data is the RGB565 palette followed by the pixels
+    as 4-bit palette indices, four to a big-endian word, with every row padded out to a
+    whole word.  Palette indices are renumbered so the colors in use come first.
+    '''
+    colors = image.getcolors(16)
+    if colors is None:
+        raise ValueError("Palette images can't have more than 16 colors")
+
+    # Map each palette index in use to its position in the compacted palette
+    used = sorted(index for count, index in colors)
+    palette = image.getpalette() or []
+    palette += [0] * (768 - len(palette))
+    lut = bytearray(256)
+    palette_rgb = bytearray()
+    for i, index in enumerate(used):
+        lut[index] = i
+        palette_rgb += bytes(palette[index*3:index*3 + 3])
+
+    palette_data = image_to_rgb565(Image.frombytes('RGB', (len(used), 1), bytes(palette_rgb)))
+
+    pixels = Image.frombytes('P', image.size, image.tobytes().translate(lut))
+    padded_width = (image.width + 3) // 4 * 4
+    if padded_width != image.width:
+        padded = Image.new('P', (padded_width, image.height), 0)
+        padded.paste(pixels, (0, 0))
+        pixels = padded
+
+    # P;4 packs two pixels per byte, first pixel in the high nibble
+    return len(used), palette_data + pixels.tobytes('raw', 'P;4')
+
+
+def image_digest(image):
+    '''
+    Returns a hex digest of an image's mode, size, palette and pixels.  The digest is
+    remembered on the image object, so images must not be modified after being hashed.
+    '''
+    digest = getattr(image, '_content_digest', None)
+    if digest is None:
+        h = hashlib.sha1(f'{image.mode} {image.width}x{image.height}'.encode())
+        if image.mode == 'P':
+            h.update(bytes(image.getpalette() or []))
+        h.update(image.tobytes())
+        digest = h.hexdigest()
+        image._content_digest = digest
+
+    return digest
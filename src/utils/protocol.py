@@ -1,6 +1,21 @@
 
+import bisect
+import collections
+import contextlib
 import math
+import os
+import struct
+import threading
+import time
 
+from PIL import Image
+
+from utils.compression import rleEncodeWords
+from utils.diskcache import PayloadCache
+from utils.imageutil import image_to_rgb565, palette_image_to_4bpp, image_digest
+from utils.stringutil import splitlines
+
+COMMAND_REQUEST_ACKNOWLEDGE = 0x00
 COMMAND_SET_TEXT_CURSOR    = 0x01
 COMMAND_WRITE_TEXT         = 0x02
 COMMAND_DRAW_PIXEL         = 0x03
@@ -13,10 +28,69 @@ COMMAND_SELECT_DISPLAY     = 0x09
 COMMAND_DRAW_PALETTE_IMAGE = 0x0A
 COMMAND_FILL_DISPLAY       = 0x0B
 COMMAND_SET_VIBRATE        = 0x0C
+COMMAND_WRITE_VRAM_RLE     = 0x0D
+COMMAND_WRITE_VRAM_RANGE   = 0x0E
+COMMAND_WRITE_TEXT_BLOCK   = 0x0F
+COMMAND_SET_BAUD           = 0x10
 
 EVENT_ON_CTP_CHANGE = 0x01
 EVENT_BATTERY_DATA  = 0x02
 EVENT_ON_KEYPRESS   = 0x03
+EVENT_ACKNOWLEDGE   = 0xFF
+
+# Packed layouts of each command.  Everything is big-endian, and the first field is always
+# the command byte.
+CMD_LAYOUT_REQUEST_ACKNOWLEDGE = struct.Struct('>B')
+CMD_LAYOUT_SET_TEXT_CURSOR    = struct.Struct('>BHH')
+CMD_LAYOUT_WRITE_TEXT         = struct.Struct('>BB')
+CMD_LAYOUT_DRAW_PIXEL         = struct.Struct('>BHHH')
+CMD_LAYOUT_RECT               = struct.Struct('>BHHHHH')
+CMD_LAYOUT_COLOR              = struct.Struct('>BH')
+CMD_LAYOUT_WRITE_VRAM         = struct.Struct('>BH')
+CMD_LAYOUT_DRAW_BITMAP        = struct.Struct('>BHHHBB')
+CMD_LAYOUT_DRAW_PALETTE_IMAGE = struct.Struct('>BHHHBBB')
+CMD_LAYOUT_SET_VIBRATE        = struct.Struct('>BB')
+
+# Sector, then the size of the compressed data that follows
+CMD_LAYOUT_WRITE_VRAM_RLE     = struct.Struct('>BHH')
+
+# First word of VRAM to write and the number of words that follow
+CMD_LAYOUT_WRITE_VRAM_RANGE   = struct.Struct('>BIH')
+
+# Position, line height, characters per line, color, and the length of the text that follows
+CMD_LAYOUT_WRITE_TEXT_BLOCK   = struct.Struct('>BHHBBHH')
+CMD_LAYOUT_SET_BAUD           = struct.Struct('>BI')
+
+# Layouts of the event payloads that follow the event byte
+EVENT_LAYOUT_BATTERY_DATA = struct.Struct('>Hh')
+EVENT_LAYOUT_KEYPRESS     = struct.Struct('>H')
+EVENT_LAYOUT_TOUCH        = struct.Struct('>HHH')
+
+VRAM_SECTOR_WORDS = 256
+VRAM_SECTOR_BYTES = VRAM_SECTOR_WORDS * 2
+
+# Most words written by one COMMAND_WRITE_VRAM_RANGE, so it fits the firmware's 1 KiB buffer
+VRAM_RANGE_MAX_WORDS = 480
+
+# Most bytes of text in one COMMAND_WRITE_TEXT_BLOCK, for the same reason
+TEXT_BLOCK_MAX_BYTES = 960
+
+# Size of each fixed-length command, including the command byte
+COMMAND_SIZES = {
+    COMMAND_REQUEST_ACKNOWLEDGE: CMD_LAYOUT_REQUEST_ACKNOWLEDGE.size,
+    COMMAND_SET_TEXT_CURSOR:    CMD_LAYOUT_SET_TEXT_CURSOR.size,
+    COMMAND_DRAW_PIXEL:         CMD_LAYOUT_DRAW_PIXEL.size,
+    COMMAND_FILL_RECT:          CMD_LAYOUT_RECT.size,
+    COMMAND_DRAW_RECT:          CMD_LAYOUT_RECT.size,
+    COMMAND_SET_TEXT_COLOR:     CMD_LAYOUT_COLOR.size,
+    COMMAND_WRITE_VRAM:         CMD_LAYOUT_WRITE_VRAM.size + VRAM_SECTOR_BYTES,
+    COMMAND_DRAW_BITMAP:        CMD_LAYOUT_DRAW_BITMAP.size,
+    COMMAND_SELECT_DISPLAY:     2,
+    COMMAND_DRAW_PALETTE_IMAGE: CMD_LAYOUT_DRAW_PALETTE_IMAGE.size,
+    COMMAND_FILL_DISPLAY:       CMD_LAYOUT_COLOR.size,
+    COMMAND_SET_VIBRATE:        CMD_LAYOUT_SET_VIBRATE.size,
+    COMMAND_SET_BAUD:           CMD_LAYOUT_SET_BAUD.size,
+}
 
 
 def rgb_to_u16(rgb):
@@ -32,16 +106,150 @@ def rgb_to_u16(rgb):
     return (blue >> 3) | ((green << 3) & 0x7e0) | ((red << 8) & 0xf800)
 
 
+def getCommandSize(data, i = 0):
+    '''
+    Returns the size of the command starting at data[i], or None if more of it is needed to
+    tell.  Unknown command bytes count as one byte, since the firmware skips them that way.
+    '''
+    cmd = data[i]
+    if cmd == COMMAND_WRITE_TEXT:
+        if len(data) - i < CMD_LAYOUT_WRITE_TEXT.size:
+            return None
+        return CMD_LAYOUT_WRITE_TEXT.size + data[i + 1]
+
+    if cmd == COMMAND_WRITE_VRAM_RLE:
+        if len(data) - i < CMD_LAYOUT_WRITE_VRAM_RLE.size:
+            return None
+        return CMD_LAYOUT_WRITE_VRAM_RLE.size + CMD_LAYOUT_WRITE_VRAM_RLE.unpack_from(data, i)[2]
+
+    if cmd == COMMAND_WRITE_VRAM_RANGE:
+        if len(data) - i < CMD_LAYOUT_WRITE_VRAM_RANGE.size:
+            return None
+        return CMD_LAYOUT_WRITE_VRAM_RANGE.size + 2 * CMD_LAYOUT_WRITE_VRAM_RANGE.unpack_from(data, i)[2]
+
+    if cmd == COMMAND_WRITE_TEXT_BLOCK:
+        if len(data) - i < CMD_LAYOUT_WRITE_TEXT_BLOCK.size:
+            return None
+        return CMD_LAYOUT_WRITE_TEXT_BLOCK.size + CMD_LAYOUT_WRITE_TEXT_BLOCK.unpack_from(data, i)[6]
+
+    return COMMAND_SIZES.get(cmd, 1)
+
+
+def rectsIntersect(a, b):
+    '''Checks if two (x, y, width, height) rectangles overlap'''
+    return a[0] < b[0] + b[2] and b[0] < a[0] + a[2] and a[1] < b[1] + b[3] and b[1] < a[1] + a[3]
+
+
+class CommandEncoder:
+    '''
+    Packs commands directly into a reusable bytearray, which only grows when a batch
+    doesn't fit.  Streams must not keep a reference to the data they are given, since
+    the same memory is reused for the next batch.
+    '''
+
+    def __init__(self, capacity = 4096):
+        self.buffer = bytearray(capacity)
+        self.length = 0
+
+        # Where each command ends, so the data can be split between commands
+        self.command_ends = []
+
+    def reserve(self, size):
+        '''Claims the next size bytes of the buffer and returns the offset they start at.'''
+        offset = self.length
+        end = offset + size
+        if end > len(self.buffer):
+            self.buffer.extend(bytes(max(end, len(self.buffer) * 2) - len(self.buffer)))
+        self.length = end
+        return offset
+
+    def pack(self, layout, *values):
+        layout.pack_into(self.buffer, self.reserve(layout.size), *values)
+        self.command_ends.append(self.length)
+
+    def packWithPayload(self, layout, values, payload, padded_size = None):
+        '''
+        Packs a command header followed by raw payload bytes.  If padded_size is given, the
+        payload is zero-padded up to that many bytes.
+        '''
+        payload_size = len(payload) if padded_size is None else padded_size
+        offset = self.reserve(layout.size + payload_size)
+        layout.pack_into(self.buffer, offset, *values)
+
+        start = offset + layout.size
+        end = start + len(payload)
+        self.buffer[start:end] = payload
+        if end < start + payload_size:
+            self.buffer[end:start + payload_size] = bytes(start + payload_size - end)
+        self.command_ends.append(self.length)
+
+    def clear(self):
+        self.length = 0
+        self.command_ends.clear()
+
+    def __len__(self):
+        return self.length
+
+
 class TabletInterface:
+    # While batching, buffered commands are sent early once they reach this many bytes
+    # so that a long frame can't hold an unbounded amount of data.
+    MAX_BATCH_SIZE = 4096
+
+    # The rate the link runs at when the tablet boots
+    DEFAULT_BAUD = 115200
+
+    # How long to wait for the tablet to acknowledge a command
+    ACKNOWLEDGE_TIMEOUT = 0.5
+
+    # How long the tablet waits to hear from us at a new baud rate before going back to the
+    # old one.  Must match PERIPHERALD_BAUD_VERIFY_MS in the firmware.
+    BAUD_VERIFY_TIME = 1.0
+
+    # Size of the tablet's command buffer.  Must match PERIPHERALD_SERIAL_BUFFER_SIZE in the
+    # firmware.  With flow control, we never send more than this ahead of the tablet.
+    DEVICE_BUFFER_SIZE = 1024
+
+    # With flow control, an acknowledgement is requested about every this many bytes
+    ACKNOWLEDGE_INTERVAL = 256
+
+    # How long to wait for an acknowledgement before assuming it got lost and the tablet
+    # has caught up
+    FLOW_CONTROL_TIMEOUT = 1.0
+
+    # Longest single wait for input while waiting for acknowledgements, in case another
+    # thread reads the acknowledgement first
+    FLOW_CONTROL_POLL = 0.01
 
     def __init__(self, stream):
         self.stream = stream
         self.lastBatteryVoltage = None
         self.lastBatteryCurrent = None
         self.presses = []
-        self._input_buffer = b''
+        self.keypresses = []
+        self.baud = self.DEFAULT_BAUD
+        self.acknowledgements = 0
+        self._input_buffer = bytearray()
+        self._input_lock = threading.Lock()
+
+        # Set when input is decoded, which can happen while waiting to send, so waitEvent()
+        # knows not to sleep
+        self._input_received = False
+
+        # Don't send more than the tablet can buffer.  Each item in _unacknowledged is the
+        # number of bytes up to and including a request for acknowledgement that hasn't been
+        # answered, and _unmarked is the number sent since the last request.
+        self.flow_control = True
+        self._unacknowledged = collections.deque()
+        self._unacknowledged_bytes = 0
+        self._unmarked = 0
+        self._encoder = CommandEncoder()
+        self._batch_depth = 0
         self.display = TabletDisplay(self)
 
+        # Optional host-side copy of the screen, see enableMirror()
+        self.mirror = None
+
     def getDisplay(self, index = 0):
         return self.display
 
@@ -54,18 +262,274 @@ class TabletInterface:
             vibe = 1
         else:
             vibe = 0
-        self._sendBytes(COMMAND_SET_VIBRATE, vibe)
+        self._sendCommand(CMD_LAYOUT_SET_VIBRATE, COMMAND_SET_VIBRATE, vibe)
 
     def getPresses(self):
         '''Use this over the presses field so the data gets updated.'''
         self._update()
         return self.presses
 
-    def _sendBytes(self, *li):
-        self.stream.write(bytes(li))
+    def getKeypresses(self):
+        '''Returns the keys pressed since the last call, oldest first.'''
+        self._update()
+        keys = self.keypresses
+        self.keypresses = []
+        return keys
+
+    def setBaud(self, baud):
+        '''
+        Asks the tablet to switch the link to another baud rate, then checks that both ends
+        can still hear each other.  If that fails, both ends go back to the old rate.  The
+        stream needs a setBaud() method for this.  Returns True if the link is now at baud.
+        '''
+        if not hasattr(self.stream, 'setBaud'):
+            return False
+
+        # Streams that can't change rate at all, like a stdin that isn't a tty, say so here
+        try:
+            self.stream.setBaud(self.baud)
+        except ValueError:
+            return False
+
+        # Wait until the tablet has handled everything sent so far.  That way the next
+        # acknowledgement is for SET_BAUD, and not one that flow control is waiting on.
+        if not self.checkLink():
+            return False
+
+        old_baud = self.baud
+        acks = self.acknowledgements
+        self._sendCommand(CMD_LAYOUT_SET_BAUD, COMMAND_SET_BAUD, baud)
+        self._waitWritten()
+        if not self._waitAcknowledge(acks):
+            # This tablet can't change its rate
+            return False
+
+        # The tablet acknowledged at the old rate, and is now listening at the new one
+        verify_deadline = time.monotonic() + self.BAUD_VERIFY_TIME
+        try:
+            self.stream.setBaud(baud)
+        except ValueError:
+            # We can't follow, so wait for the tablet to give up and go back to the old rate
+            time.sleep(max(verify_deadline - time.monotonic(), 0))
+            self.checkLink()
+            return False
+
+        if self.checkLink():
+            self.baud = baud
+            return True
+
+        # Wait for the tablet to give up and go back to the old rate
+        time.sleep(max(verify_deadline - time.monotonic(), 0))
+        self.stream.setBaud(old_baud)
+        if self.checkLink():
+            return False
+
+        # Only our acknowledgement got lost, and the tablet kept the new rate
+        self.stream.setBaud(baud)
+        if self.checkLink():
+            self.baud = baud
+            return True
+
+        self.stream.setBaud(old_baud)
+        return False
+
+    def checkLink(self):
+        '''Asks the tablet to acknowledge, and returns True if it does in time.'''
+        self._waitWritten()
+
+        # Acknowledgements flow control asked for could be taken for ours, so let them come in
+        deadline = time.monotonic() + self.FLOW_CONTROL_TIMEOUT
+        while len(self._unacknowledged) > 0 and time.monotonic() < deadline:
+            self._update()
+            self.stream.wait(self.FLOW_CONTROL_POLL)
+        self._resetFlowControl()
+
+        # Anything that came in before this could be noise from a rate change
+        self._discardInput()
+
+        acks = self.acknowledgements
+        self._sendCommand(CMD_LAYOUT_REQUEST_ACKNOWLEDGE, COMMAND_REQUEST_ACKNOWLEDGE)
+        self._waitWritten()
+        if not self._waitAcknowledge(acks):
+            return False
+
+        # The tablet has handled everything we sent
+        self._resetFlowControl()
+        return True
+
+    def _waitAcknowledge(self, acks):
+        '''Waits until more than acks acknowledgements have arrived, or the timeout passes.'''
+        deadline = time.monotonic() + self.ACKNOWLEDGE_TIMEOUT
+        while True:
+            self._update()
+            if self.acknowledgements > acks:
+                return True
+
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            self.stream.wait(remaining)
+
+    def _discardInput(self):
+        while self.stream.available():
+            self.stream.read()
+        self._input_buffer.clear()
+
+    def enableMirror(self):
+        '''
+        Starts keeping a copy of the screen on this side of the link, by running everything
+        sent from now on through a utils.framebuffer.Framebuffer.  That needs numpy.  The copy
+        starts out black, so clear or redraw the screen after enabling it.  Returns the
+        Framebuffer.
+        '''
+        if self.mirror is None:
+            from utils.framebuffer import Framebuffer
+            self.mirror = Framebuffer(self.display.getWidth(), self.display.getHeight(), self.display.vram_cache.total_sectors)
+
+        return self.mirror
+
+    def waitEvent(self, timeout = None):
+        '''
+        Sends anything that is buffered, then sleeps until the tablet sends input or timeout
+        seconds pass.  A timeout of None waits forever.  Returns True if input arrived.
+        '''
+        self.flush()
+        if self._takeInputReceived():
+            return True
+
+        if not self.stream.wait(timeout):
+            return False
+
+        # Decode it now, so it doesn't make the next call return straight away
+        self._update()
+        self._takeInputReceived()
+        return True
+
+    def _takeInputReceived(self):
+        '''Returns whether input was decoded since the last call.'''
+        with self._input_lock:
+            received = self._input_received
+            self._input_received = False
+        return received
+
+    def flush(self):
+        '''Sends every command that has been buffered by frame() so far.'''
+        if len(self._encoder) > 0:
+            with memoryview(self._encoder.buffer) as view, view[:len(self._encoder)] as data:
+                if self.mirror is not None:
+                    self.mirror.write(data)
+                self._transmit(data, self._encoder.command_ends)
+            self._encoder.clear()
+
+    def _transmit(self, data, command_ends):
+        '''
+        Writes data to the stream.  With flow control, the data is split between commands and
+        held back while the tablet's buffer is full, and acknowledgements are requested now
+        and then so we know when it has room again.
+        '''
+        if not self.flow_control:
+            self.stream.write(data)
+            return
+
+        out = bytearray()
+        start = 0
+        next_end = 0
+        while start < len(data):
+            # Take whole commands up to ACKNOWLEDGE_INTERVAL bytes, or one longer command
+            end = command_ends[next_end]
+            next_end += 1
+            while next_end < len(command_ends) and command_ends[next_end] - start <= self.ACKNOWLEDGE_INTERVAL:
+                end = command_ends[next_end]
+                next_end += 1
+
+            if not self._hasRoomFor(end - start):
+                # Send what we have, since the tablet can't make room until it gets it
+                if len(out) > 0:
+                    self.stream.write(out)
+                    out.clear()
+                self._waitForRoom(end - start)
+
+            out += data[start:end]
+            self._unmarked += end - start
+            if self._unmarked >= self.ACKNOWLEDGE_INTERVAL:
+                out.append(COMMAND_REQUEST_ACKNOWLEDGE)
+                self._markSent()
+            start = end
+
+        if len(out) > 0:
+            self.stream.write(out)
+
+    def _hasRoomFor(self, size):
+        # One byte is kept free for a request for acknowledgement
+        return self._unacknowledged_bytes + self._unmarked + size < self.DEVICE_BUFFER_SIZE
+
+    def _markSent(self):
+        with self._input_lock:
+            self._unacknowledged.append(self._unmarked + 1)
+            self._unacknowledged_bytes += self._unmarked + 1
+            self._unmarked = 0
+
+    def _waitForRoom(self, size):
+        deadline = time.monotonic() + self.FLOW_CONTROL_TIMEOUT
+        while True:
+            self._update()
+            if self._hasRoomFor(size):
+                return
+
+            if self._unmarked > 0:
+                # Nothing we're waiting on covers the latest bytes, so ask about them
+                self.stream.write(CMD_LAYOUT_REQUEST_ACKNOWLEDGE.pack(COMMAND_REQUEST_ACKNOWLEDGE))
+                self._markSent()
+
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                # The acknowledgements got lost, so assume the tablet has caught up by now
+                self._resetFlowControl()
+                return
+            self.stream.wait(min(remaining, self.FLOW_CONTROL_POLL))
+
+    def _resetFlowControl(self):
+        with self._input_lock:
+            self._unacknowledged.clear()
+            self._unacknowledged_bytes = 0
+            self._unmarked = 0
+
+    def _waitWritten(self):
+        '''Sends everything buffered, and returns once the stream has it.'''
+        self.flush()
+
+    @contextlib.contextmanager
+    def frame(self):
+        '''
+        Buffers all commands sent inside the with block and writes them to the stream
+        together when the outermost frame ends.  Frames can be nested.
+        '''
+        self._batch_depth += 1
+        try:
+            yield self
+        finally:
+            self._batch_depth -= 1
+            if self._batch_depth == 0:
+                self.flush()
+
+    def _sendCommand(self, layout, *values):
+        self._encoder.pack(layout, *values)
+        self._commandAdded()
+
+    def _sendCommandWithPayload(self, layout, values, payload, padded_size = None):
+        self._encoder.packWithPayload(layout, values, payload, padded_size)
+        self._commandAdded()
+
+    def _commandAdded(self):
+        if self._batch_depth == 0 or len(self._encoder) >= self.MAX_BATCH_SIZE:
+            self.flush()
 
     def _update(self):
+        # With flow control, input can also be read by a thread waiting to write
+        with self._input_lock:
+            self._readEvents()
 
+    def _readEvents(self):
         if not self.stream.available():
             # Nothing changed since last update, return
             return
@@ -74,238 +538,492 @@ class TabletInterface:
         while self.stream.available():
             self._input_buffer += self.stream.read()
 
-        while len(self._input_buffer) > 0:
-            event = self._input_buffer[0]
+        # Decode events in place, and only drop the consumed bytes once at the end
+        buf = self._input_buffer
+        i = 0
+        while i < len(buf):
+            event = buf[i]
 
             if event == EVENT_BATTERY_DATA:
-                if len(self._input_buffer) < 5:
+                if len(buf) - i < 1 + EVENT_LAYOUT_BATTERY_DATA.size:
                     break
 
-                self.lastBatteryVoltage = ((self._input_buffer[1] << 8) | self._input_buffer[2]) / 100
-                self.lastBatteryCurrentA = ((self._input_buffer[3] << 8) | self._input_buffer[4]) / 1000
-
-                # Handle conversion to signed integer (well, float here, but integer as
-                # far as the protocol is concerned)
-                if self.lastBatteryCurrentA > 32767 / 1000:
-                    self.lastBatteryCurrentA -= 65536 / 1000
+                # Current is a signed integer in milliamps
+                voltage, current = EVENT_LAYOUT_BATTERY_DATA.unpack_from(buf, i + 1)
+                self.lastBatteryVoltage = voltage / 100
+                self.lastBatteryCurrentA = current / 1000
+                self._input_received = True
 
-                sz = 5
+                i += 1 + EVENT_LAYOUT_BATTERY_DATA.size
 
             elif event == EVENT_ON_CTP_CHANGE:
-                if len(self._input_buffer) < 2:
+                if len(buf) - i < 2:
+                    break
+
+                n = buf[i + 1]
+                if len(buf) - i < 2 + EVENT_LAYOUT_TOUCH.size * n:
                     break
 
-                n = self._input_buffer[1]
+                self.presses = [
+                    EVENT_LAYOUT_TOUCH.unpack_from(buf, i + 2 + EVENT_LAYOUT_TOUCH.size * j)
+                    for j in range(n)
+                ]
+                self._input_received = True
+                i += 2 + EVENT_LAYOUT_TOUCH.size * n
 
-                if len(self._input_buffer) < 2 + 6 * n:
+            elif event == EVENT_ON_KEYPRESS:
+                if len(buf) - i < 1 + EVENT_LAYOUT_KEYPRESS.size:
                     break
 
-                presses = []
-                for i in range(n):
-                    x = (self._input_buffer[6*i + 2] << 8) | self._input_buffer[6*i + 3]
-                    y = (self._input_buffer[6*i + 4] << 8) | self._input_buffer[6*i + 5]
-                    z = (self._input_buffer[6*i + 6] << 8) | self._input_buffer[6*i + 7]
-                    presses.append((x, y, z))
+                self.keypresses.append(EVENT_LAYOUT_KEYPRESS.unpack_from(buf, i + 1)[0])
+                self._input_received = True
+                i += 1 + EVENT_LAYOUT_KEYPRESS.size
 
-                self.presses = presses
-                sz = 2 + 6 * n
+            elif event == EVENT_ACKNOWLEDGE:
+                self.acknowledgements += 1
+                if len(self._unacknowledged) > 0:
+                    self._unacknowledged_bytes -= self._unacknowledged.popleft()
+                i += 1
 
             else:
                 # Invalid
-                sz = 1
+                i += 1
 
-            self._input_buffer = self._input_buffer[sz:]
+        del buf[:i]
 
 
 class VRAMObject:
-    def __init__(self, first_sector, num_sectors, value):
+    def __init__(self, first_sector, num_sectors, value, key = None):
         self.first_sector = first_sector
         self.num_sectors = num_sectors
         self.last_sector = first_sector + num_sectors - 1
         self.value = value
+        self.key = key
         self.num_accesses = 1
+        self.last_access = 0
 
 
 class VRAMCache:
     def __init__(self, total_sectors):
+        # Items never overlap, and are kept sorted by first sector so that sector lookups
+        # can bisect the parallel list of start sectors.
         self.items = []
+        self._item_starts = []
+        self._items_by_key = {}
         self.total_sectors = total_sectors
 
+        # Counts lookups and additions, so items can tell how recently they were used
+        self._access_clock = 0
+
+    @staticmethod
+    def getKey(value):
+        '''Images are indexed by a hash of their contents, anything else by its own value.'''
+        if isinstance(value, Image.Image):
+            return image_digest(value)
+        return value
+
     def getSectorOf(self, value):
-        for i in self.items:
-            if i.value == value:
-                i.num_accesses += 1
-                return i.first_sector
+        item = self._items_by_key.get(self.getKey(value))
+        if item is None:
+            return None
 
-        return None
+        self._access_clock += 1
+        item.num_accesses += 1
+        item.last_access = self._access_clock
+        return item.first_sector
 
     def getItemInSector(self, sector):
-        for i in self.items:
-            if sector >= i.first_sector and sector <= i.last_sector:
-                return i
+        idx = bisect.bisect_right(self._item_starts, sector) - 1
+        if idx >= 0 and sector <= self.items[idx].last_sector:
+            return self.items[idx]
 
         return None
 
     def getItemsInSectors(self, first, last):
+        # Start from the last item beginning at or before the range, since it may run into it
+        idx = max(bisect.bisect_right(self._item_starts, first) - 1, 0)
         found = []
-        for i in self.items:
-            if last >= i.first_sector and first <= i.last_sector:
-                found.append(i)
+        while idx < len(self.items) and self.items[idx].first_sector <= last:
+            if self.items[idx].last_sector >= first:
+                found.append(self.items[idx])
+            idx += 1
 
         return found
 
     def addItem(self, first_sector, num_sectors, value):
-        item = VRAMObject(first_sector, num_sectors, value)
+        item = VRAMObject(first_sector, num_sectors, value, self.getKey(value))
+        self._access_clock += 1
+        item.last_access = self._access_clock
 
-        # Remove things that were overwritten
+        # Remove things that were overwritten, and any older copy of the same value
         items_overwritten = self.getItemsInSectors(item.first_sector, item.last_sector)
+        if item.key in self._items_by_key:
+            items_overwritten.append(self._items_by_key[item.key])
         for i in items_overwritten:
-            self.items.remove(i)
+            self.removeItem(i)
 
-        self.items.append(item)
+        idx = bisect.bisect_left(self._item_starts, item.first_sector)
+        self.items.insert(idx, item)
+        self._item_starts.insert(idx, item.first_sector)
+        self._items_by_key[item.key] = item
 
-    def getFreeChunk(self, size):
-        proposed_start = 0
-        end = proposed_start + size - 1
-        i = 0
-        while i < len(self.items):
-            if end >= self.items[i].first_sector and proposed_start <= self.items[i].last_sector:
-                # Recompute proposed start
-                proposed_start = self.items[i].last_sector + 1
-                end = proposed_start + size - 1
-
-                # Check if we're out of VRAM
-                if end >= self.total_sectors:
-                    return None
-
-                # Reset item iterator
-                i = 0
-            else:
-                # Check the next item
-                i += 1
+    def removeItem(self, item):
+        idx = bisect.bisect_left(self._item_starts, item.first_sector)
+        if idx < len(self.items) and self.items[idx] is item:
+            del self.items[idx]
+            del self._item_starts[idx]
+            if self._items_by_key.get(item.key) is item:
+                del self._items_by_key[item.key]
 
-        return proposed_start
+    def getFreeChunk(self, size):
+        '''
+        Returns the first sector of the smallest free gap that can hold size sectors, or
+        None if there is no such gap.
+        '''
+        best_start = None
+        best_gap = None
+        gap_start = 0
+        for i in self.items + [None]:
+            gap_end = self.total_sectors if i is None else i.first_sector
+            gap = gap_end - gap_start
+            if gap >= size and (best_gap is None or gap < best_gap):
+                best_start = gap_start
+                best_gap = gap
+            if i is not None:
+                gap_start = i.last_sector + 1
+
+        return best_start
 
     def getBestChunk(self, size):
-        # TODO: Implement this
-        return 0
+        '''
+        Picks where to put size sectors when there is no free gap big enough.  The chosen
+        range is the one whose most recently used item is the oldest, and then the one whose
+        items have been used the least, so images that are still being drawn survive.
+
+        Returns None if size is bigger than all of VRAM.
+        '''
+        if size > self.total_sectors:
+            return None
+
+        # The best range always starts at the start of VRAM, an item, or just after an item
+        candidates = {0}
+        for i in self.items:
+            candidates.add(i.first_sector)
+            candidates.add(i.last_sector + 1)
+
+        best_start = None
+        best_cost = None
+        for start in candidates:
+            if start + size > self.total_sectors:
+                continue
+
+            evicted = self.getItemsInSectors(start, start + size - 1)
+            cost = (
+                max((i.last_access for i in evicted), default=0),
+                sum(i.num_accesses for i in evicted)
+            )
+            if best_cost is None or cost < best_cost:
+                best_start = start
+                best_cost = cost
+
+        return best_start
 
 
 class TabletDisplay:
+    # Size of the tiles that images over 255x255 are split into.  A full RGB565 tile is
+    # exactly 64 VRAM sectors.
+    TILE_SIZE = 128
+
+    # Where encoded images are kept between runs, up to PayloadCache.MAX_SIZE bytes.  Set
+    # payload_cache to None to disable it.
+    PAYLOAD_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'tablet_software', 'vram')
 
     def __init__(self, iface):
         self.iface = iface
         self.vram_cache = VRAMCache(1024)
+        self.payload_cache = PayloadCache(self.PAYLOAD_CACHE_DIR)
+
+        # Send VRAM sectors run-length encoded when that's smaller.  Turn this off for
+        # firmware without COMMAND_WRITE_VRAM_RLE.
+        self.compress_vram = True
+
+        # Skip commands that wouldn't change what's on screen
+        self.skip_redundant = True
+        self.resetShadowState()
+
+    def resetShadowState(self):
+        '''
+        Forgets everything we know about the display's state.  Call this if anything else
+        might have drawn to the display, or the display might have been reset.
+        '''
+        # The text cursor and color the display actually has, or None if unknown.  The ones
+        # set by the application are only sent when text is written.
+        self._device_cursor = None
+        self._device_text_color = None
+        self._cursor = None
+        self._text_color = None
+
+        # Maps an (x, y, width, height) area to the last command that drew exactly that area,
+        # for as long as nothing else has been drawn over any part of it.  Repeating such a
+        # command wouldn't change any pixels.
+        self._drawn_regions = {}
+
+    def _isOnScreen(self, bounds, key):
+        return self.skip_redundant and bounds is not None and self._drawn_regions.get(bounds) == key
+
+    def _markDrawn(self, bounds, key):
+        if bounds is None:
+            # Could have drawn anywhere
+            self._drawn_regions.clear()
+            return
+
+        for rect in [r for r in self._drawn_regions if rectsIntersect(r, bounds)]:
+            del self._drawn_regions[rect]
+        self._drawn_regions[bounds] = key
+
+    def _drawCommand(self, bounds, key, layout, *values):
+        '''Sends a drawing command, unless it would redraw exactly what's already there.'''
+        if self._isOnScreen(bounds, key):
+            return
+
+        self.iface._sendCommand(layout, *values)
+        self._markDrawn(bounds, key)
 
     def setTextColor(self, rgb):
-        c = rgb_to_u16(rgb)
-        self.iface._sendBytes(COMMAND_SET_TEXT_COLOR, c >> 8, c & 255)
+        self._text_color = rgb_to_u16(rgb)
 
     def drawPixel(self, x, y, rgb):
         c = rgb_to_u16(rgb)
-        self.iface._sendBytes(COMMAND_DRAW_PIXEL, x >> 8, x & 255, y >> 8, y & 255, c >> 8, c & 255)
+        self._drawCommand((x, y, 1, 1), (COMMAND_DRAW_PIXEL, c),
+                          CMD_LAYOUT_DRAW_PIXEL, COMMAND_DRAW_PIXEL, x, y, c)
 
     def fillRect(self, x, y, w, h, rgb):
+        # The far corner may be inclusive, so the bounds include it
         c = rgb_to_u16(rgb)
-        x2 = x + w
-        y2 = y + h
-        self.iface._sendBytes(
-            COMMAND_FILL_RECT,
-            x >> 8, x & 255, y >> 8, y & 255,
-            x2 >> 8, x2 & 255, y2 >> 8, y2 & 255,
-            c >> 8, c & 255
-        )
+        self._drawCommand((x, y, w + 1, h + 1), (COMMAND_FILL_RECT, c),
+                          CMD_LAYOUT_RECT, COMMAND_FILL_RECT, x, y, x + w, y + h, c)
 
     def drawRect(self, x, y, w, h, rgb):
         c = rgb_to_u16(rgb)
-        x2 = x + w
-        y2 = y + h
-        self.iface._sendBytes(
-            COMMAND_DRAW_RECT,
-            x >> 8, x & 255, y >> 8, y & 255,
-            x2 >> 8, x2 & 255, y2 >> 8, y2 & 255,
-            c >> 8, c & 255
-        )
+        self._drawCommand((x, y, w + 1, h + 1), (COMMAND_DRAW_RECT, c),
+                          CMD_LAYOUT_RECT, COMMAND_DRAW_RECT, x, y, x + w, y + h, c)
 
     def writeText(self, text):
         for i in range(math.ceil(len(text) / 255)):
             s = text[i*255: i*255 + 255].encode()
-            self.iface._sendBytes(COMMAND_WRITE_TEXT, len(s), *s)
 
-    def setCursor(self, x, y):
-        self.iface._sendBytes(
-            COMMAND_SET_TEXT_CURSOR,
-            x >> 8, x & 255,
-            y >> 8, y & 255
+            # Text runs along one line unless it has newlines or hits the edge of the screen
+            end_cursor = None
+            bounds = None
+            if self._cursor is not None and b'\n' not in s:
+                x, y = self._cursor
+                if x + 8 * len(s) <= self.getWidth():
+                    end_cursor = (x + 8 * len(s), y)
+                    bounds = (x, y, 8 * len(s), 12)
+
+            key = (COMMAND_WRITE_TEXT, s, self._text_color)
+            if not self._isOnScreen(bounds, key):
+                self._syncTextState()
+                self.iface._sendCommandWithPayload(CMD_LAYOUT_WRITE_TEXT, (COMMAND_WRITE_TEXT, len(s)), s)
+                self._markDrawn(bounds, key)
+                self._device_cursor = end_cursor
+
+            self._cursor = end_cursor
+
+    def writeTextBlock(self, x, y, text, chars_per_line, rgb, line_height = 12):
+        '''
+        Writes a paragraph starting at (x, y), wrapped to chars_per_line characters the same
+        way as stringutil.splitlines, with its lines line_height pixels apart.  The display
+        does the wrapping, so the paragraph is sent as one command instead of one per line.
+
+        This sets the text color to rgb, and leaves the text cursor undefined.  Returns the
+        number of lines written.
+        '''
+        c = rgb_to_u16(rgb)
+        lines = splitlines(text.encode(), ord(' '), chars_per_line)
+
+        # Long paragraphs are sent as several blocks, split between lines.  The display
+        # wraps each block on its own, which can come out differently from wrapping the
+        # whole paragraph, so a block is only used if it wraps into the same lines.
+        first = 0
+        while first < len(lines):
+            last = first + 1
+            size = len(lines[first])
+            while last < len(lines) and size + 1 + len(lines[last]) <= TEXT_BLOCK_MAX_BYTES:
+                size += 1 + len(lines[last])
+                last += 1
+
+            while True:
+                # splitlines only drops the space each line was split at
+                block = b' '.join(lines[first:last])[:TEXT_BLOCK_MAX_BYTES]
+                drawn = splitlines(block, ord(' '), chars_per_line)
+                if drawn == lines[first:last] or last == first + 1:
+                    break
+                last -= 1
+
+            if drawn != lines[first:last]:
+                # splitlines can leave a line one character longer than chars_per_line after
+                # a split, which the display would wrap again on its own.  Draw it as is.
+                self._cursor = (x, y + first * line_height)
+                self._text_color = c
+                self.writeText(lines[first].decode())
+            elif len(block) > 0:
+                self._writeTextBlock(x, y + first * line_height, block, drawn, chars_per_line, line_height, c)
+            first = last
+
+        self._cursor = None
+        self._text_color = c
+        return len(lines)
+
+    def _writeTextBlock(self, x, y, block, lines, chars_per_line, line_height, c):
+        width = 8 * max(len(line) for line in lines)
+        bounds = None
+        if x + width <= self.getWidth():
+            bounds = (x, y, width, (len(lines) - 1) * line_height + 12)
+
+        key = (COMMAND_WRITE_TEXT_BLOCK, block, chars_per_line, line_height, c)
+        if self._isOnScreen(bounds, key):
+            return
+
+        self.iface._sendCommandWithPayload(
+            CMD_LAYOUT_WRITE_TEXT_BLOCK,
+            (COMMAND_WRITE_TEXT_BLOCK, x, y, line_height, chars_per_line, c, len(block)),
+            block
         )
+        self._markDrawn(bounds, key)
+        self._device_cursor = None
+        self._device_text_color = c
+
+    def setCursor(self, x, y):
+        self._cursor = (x, y)
+
+    def _syncTextState(self):
+        '''Sends the text cursor and color, if the display doesn't already have them.'''
+        if self._cursor is None or self._cursor != self._device_cursor or not self.skip_redundant:
+            if self._cursor is not None:
+                self.iface._sendCommand(CMD_LAYOUT_SET_TEXT_CURSOR, COMMAND_SET_TEXT_CURSOR, *self._cursor)
+            self._device_cursor = self._cursor
+
+        if self._text_color is not None and (self._text_color != self._device_text_color or not self.skip_redundant):
+            self.iface._sendCommand(CMD_LAYOUT_COLOR, COMMAND_SET_TEXT_COLOR, self._text_color)
+            self._device_text_color = self._text_color
 
     def writeVRAM(self, sector, data):
-        if type(data) != list:
-            raise TypeError("Need a list of 16-bit integers, not " + str(type(data)))
-        if len(data) > 256:
-            raise ValueError(f"Wrong data size: {len(data)} (expected <= 256 16-bit words)")
+        '''
+        Writes one sector of VRAM.  data is either a list of up to 256 16-bit integers or a
+        bytes-like object holding up to 512 bytes of big-endian words.  Short data is padded
+        with zeros.  The sector is sent compressed if compress_vram is set and it saves space.
+        '''
+        if type(data) == list:
+            if len(data) > VRAM_SECTOR_WORDS:
+                raise ValueError(f"Wrong data size: {len(data)} (expected <= 256 16-bit words)")
+            data = struct.pack(f'>{len(data)}H', *data)
+        elif not isinstance(data, (bytes, bytearray, memoryview)):
+            raise TypeError("Need a list of 16-bit integers or bytes, not " + str(type(data)))
+        elif len(data) > VRAM_SECTOR_BYTES:
+            raise ValueError(f"Wrong data size: {len(data)} (expected <= 512 bytes)")
+
+        # Whatever was cached here is gone, and so is anything drawn from it
+        for i in self.vram_cache.getItemsInSectors(sector, sector):
+            self.vram_cache.removeItem(i)
+
+        if self.compress_vram:
+            compressed = rleEncodeWords(data)
+            if CMD_LAYOUT_WRITE_VRAM_RLE.size + len(compressed) < CMD_LAYOUT_WRITE_VRAM.size + VRAM_SECTOR_BYTES:
+                self.iface._sendCommandWithPayload(
+                    CMD_LAYOUT_WRITE_VRAM_RLE, (COMMAND_WRITE_VRAM_RLE, sector, len(compressed)), compressed
+                )
+                return
+
+        self.iface._sendCommandWithPayload(
+            CMD_LAYOUT_WRITE_VRAM, (COMMAND_WRITE_VRAM, sector), data, VRAM_SECTOR_BYTES
+        )
 
-        li = []
-        for i in data:
-            li.append(i >> 8)
-            li.append(i & 255)
+    def writeVRAMRange(self, first_word, data):
+        '''
+        Writes words to VRAM starting at any word, without padding.  data is either a list of
+        16-bit integers or a bytes-like object holding big-endian words, and may span sectors.
+        '''
+        if type(data) == list:
+            data = struct.pack(f'>{len(data)}H', *data)
+        elif not isinstance(data, (bytes, bytearray, memoryview)):
+            raise TypeError("Need a list of 16-bit integers or bytes, not " + str(type(data)))
+        elif len(data) % 2 != 0:
+            raise ValueError(f"Wrong data size: {len(data)} (expected whole 16-bit words)")
+
+        num_words = len(data) // 2
+        if num_words == 0:
+            return
 
-        if len(li) < 512:
-            li += [0] * (512 - len(li))
+        for i in self.vram_cache.getItemsInSectors(first_word // VRAM_SECTOR_WORDS, (first_word + num_words - 1) // VRAM_SECTOR_WORDS):
+            self.vram_cache.removeItem(i)
+
+        with memoryview(data) as view:
+            for start in range(0, num_words, VRAM_RANGE_MAX_WORDS):
+                chunk = view[start*2:(start + VRAM_RANGE_MAX_WORDS)*2]
+                self.iface._sendCommandWithPayload(
+                    CMD_LAYOUT_WRITE_VRAM_RANGE, (COMMAND_WRITE_VRAM_RANGE, first_word + start, len(chunk) // 2), chunk
+                )
+
+    def _uploadPayload(self, start_sector, data):
+        '''
+        Writes data to VRAM from the start of start_sector, compressing the sectors where
+        that helps.  The rest is sent as range writes, which span sectors and leave out the
+        padding at the end.  Returns the number of sectors used.
+        '''
+        num_sectors = math.ceil(len(data) / VRAM_SECTOR_BYTES)
+        first_word = start_sector * VRAM_SECTOR_WORDS
+        with memoryview(data) as view:
+            # Everything before raw_start has been sent
+            raw_start = 0
+            for i in range(num_sectors):
+                if not self.compress_vram:
+                    break
 
-        self.iface._sendBytes(COMMAND_WRITE_VRAM, sector >> 8, sector & 255, *li)
+                sector_data = view[i*VRAM_SECTOR_BYTES:(i+1)*VRAM_SECTOR_BYTES]
+                compressed = rleEncodeWords(sector_data)
+                if CMD_LAYOUT_WRITE_VRAM_RLE.size + len(compressed) >= len(sector_data):
+                    continue
 
-    def loadBitmap(self, start_sector, image):
-        xs = image.width
-        ys = image.height
+                self.writeVRAMRange(first_word + raw_start // 2, view[raw_start:i*VRAM_SECTOR_BYTES])
+                self.iface._sendCommandWithPayload(
+                    CMD_LAYOUT_WRITE_VRAM_RLE, (COMMAND_WRITE_VRAM_RLE, start_sector + i, len(compressed)), compressed
+                )
+                raw_start = (i + 1) * VRAM_SECTOR_BYTES
 
-        # Load up the image data because it's not cached
-        bitmap_data = []
-        for y in range(ys):
-            for x in range(xs):
-                color = image.getpixel((x, y))
-                u16 = rgb_to_u16(color)
-                bitmap_data.append(u16)
+            self.writeVRAMRange(first_word + raw_start // 2, view[raw_start:])
 
-        num_sectors = math.ceil(xs * ys / 256)
-        for i in range(num_sectors):
-            self.writeVRAM(start_sector + i, bitmap_data[i*256:(i+1)*256])
+        return num_sectors
 
-        self.vram_cache.addItem(start_sector, math.ceil(xs * ys / 256), image)
+    def loadBitmap(self, start_sector, image):
+        # Load up the image data because it's not cached
+        bitmap_data = self._encodeImage(image, 'rgb565', image_to_rgb565)
 
-    def loadPaletteImage(self, start_sector, image):
-        xs = image.width
-        ys = image.height
+        num_sectors = self._uploadPayload(start_sector, bitmap_data)
+        self.vram_cache.addItem(start_sector, num_sectors, image)
 
-        bitmap_data = []
+    def loadPaletteImage(self, start_sector, image):
+        bitmap_data = self._encodeImage(image, '4bpp', lambda im: palette_image_to_4bpp(im)[1])
 
-        # Get color data first
-        color_data = image.getpalette()
-        n_colors = len(image.getcolors())
-        for i in range(n_colors):
-            rgb = color_data[i*3:i*3 + 3]
-            bitmap_data.append(rgb_to_u16(rgb))
+        num_sectors = self._uploadPayload(start_sector, bitmap_data)
+        self.vram_cache.addItem(start_sector, num_sectors, image)
 
-        # Now the pixel data
-        for y in range(ys):
-            for x in range(0, xs, 4):
-                p0 = image.getpixel((x + 0, y))
-                p1 = image.getpixel((x + 1, y))
-                p2 = image.getpixel((x + 2, y))
-                p3 = image.getpixel((x + 3, y))
-                bitmap_data.append((p0 << 12) | (p1 << 8) | (p2 << 4) | p3)
+    def _encodeImage(self, image, encoding, encoder):
+        '''Returns encoder(image), using the on-disk payload cache when possible.'''
+        if self.payload_cache is None:
+            return encoder(image)
 
-        num_sectors = math.ceil((xs * ys / 4 + n_colors) / 256)
-        for i in range(num_sectors):
-            self.writeVRAM(start_sector + i, bitmap_data[i*256:(i+1)*256])
+        key = f'{image_digest(image)}-{encoding}'
+        data = self.payload_cache.get(key)
+        if data is None:
+            data = encoder(image)
+            self.payload_cache.put(key, data)
 
-        self.vram_cache.addItem(start_sector, math.ceil(xs * ys / 256), image)
+        return data
 
     def drawLoadedBitmap(self, sector, x, y, w, h):
-        self.iface._sendBytes(COMMAND_DRAW_BITMAP, sector >> 8, sector & 255,
-                              x >> 8, x & 255,
-                              y >> 8, y & 255,
-                              w, h)
+        self._drawCommand((x, y, w, h), self._getImageKey(COMMAND_DRAW_BITMAP, sector, w, h),
+                          CMD_LAYOUT_DRAW_BITMAP, COMMAND_DRAW_BITMAP, sector, x, y, w, h)
 
     def loadImage(self, image):
         xs = image.width
@@ -317,15 +1035,18 @@ class TabletDisplay:
 
         if start_sector is None:
             if is_palette_image:
-                num_sectors = math.ceil((xs * ys / 4 + 16) / 256)
+                num_sectors = math.ceil((math.ceil(xs / 4) * ys + 16) / 256)
             else:
                 num_sectors = math.ceil(xs * ys / 256)
             start_sector = self.vram_cache.getFreeChunk(num_sectors)
 
             if start_sector is None:
-                # No free space of the requested size
+                # No free space of the requested size, evict whatever is least useful
                 start_sector = self.vram_cache.getBestChunk(num_sectors)
 
+            if start_sector is None:
+                raise ValueError(f"Image needs {num_sectors} sectors, which is more than all of VRAM")
+
             # Load up the image data because it's not cached
             if is_palette_image:
                 self.loadPaletteImage(start_sector, image)
@@ -337,12 +1058,24 @@ class TabletDisplay:
     def drawImage(self, xp, yp, image):
         xs = image.width
         ys = image.height
-        is_palette_image = image.mode == 'P' and (len(image.getcolors()) <= 16)
 
-        # We could use multiple draws to do large images later
+        # The draw commands only have 8 bits for the size, so big images are drawn in tiles
         if xs > 255 or ys > 255:
-            raise ValueError("Image must be within 256x256 pixels")
+            self.drawTiledImage(xp, yp, image)
+            return
+
+        # The draw commands can't place images above or left of the screen, so crop that off
+        if xp < 0 or yp < 0:
+            if xp + xs <= 0 or yp + ys <= 0:
+                return
 
+            image = image.crop((max(-xp, 0), max(-yp, 0), xs, ys))
+            xp = max(xp, 0)
+            yp = max(yp, 0)
+            xs = image.width
+            ys = image.height
+
+        is_palette_image = image.mode == 'P' and (len(image.getcolors()) <= 16)
         start_sector = self.loadImage(image)
 
         # Draw the image
@@ -351,18 +1084,55 @@ class TabletDisplay:
         else:
             self.drawLoadedBitmap(start_sector, xp, yp, xs, ys)
 
+    def drawTiledImage(self, xp, yp, image):
+        '''
+        Draws an image of any size as a grid of tiles.  Each tile is cached in VRAM on its own,
+        and tiles that are entirely off screen are skipped without being uploaded.
+        '''
+        for tile_x, tile_y, tile in self._getTiles(image):
+            x = xp + tile_x
+            y = yp + tile_y
+            if x >= self.getWidth() or y >= self.getHeight() or x + tile.width <= 0 or y + tile.height <= 0:
+                continue
+
+            self.drawImage(x, y, tile)
+
+    def _getTiles(self, image):
+        '''
+        Splits an image into TILE_SIZE tiles.  The tiles are remembered on the image, so
+        redrawing it doesn't crop (or hash) it again.
+        '''
+        tiles = getattr(image, '_tiles', None)
+        if tiles is None:
+            tiles = []
+            for y in range(0, image.height, self.TILE_SIZE):
+                for x in range(0, image.width, self.TILE_SIZE):
+                    box = (x, y, min(x + self.TILE_SIZE, image.width), min(y + self.TILE_SIZE, image.height))
+                    tiles.append((x, y, image.crop(box)))
+            image._tiles = tiles
+
+        return tiles
+
     def drawPaletteImage(self, sector, x, y, w, h, paletteSize):
-        self.iface._sendBytes(COMMAND_DRAW_PALETTE_IMAGE, sector >> 8, sector & 255,
-                              x >> 8, x & 255,
-                              y >> 8, y & 255,
-                              w, h, paletteSize)
+        self._drawCommand((x, y, w, h), self._getImageKey(COMMAND_DRAW_PALETTE_IMAGE, sector, w, h, paletteSize),
+                          CMD_LAYOUT_DRAW_PALETTE_IMAGE, COMMAND_DRAW_PALETTE_IMAGE,
+                          sector, x, y, w, h, paletteSize)
+
+    def _getImageKey(self, *command):
+        # Any write to the image's sectors replaces its cache item, so the item tells us if
+        # the VRAM contents are still the same.  Untracked VRAM never matches.
+        item = self.vram_cache.getItemInSector(command[1])
+        return command + (object() if item is None else item,)
 
     def fillScreen(self, rgb):
-        color = rgb_to_u16(rgb)
-        self.iface._sendBytes(
-            COMMAND_FILL_DISPLAY,
-            color >> 8, color & 255
-        )
+        c = rgb_to_u16(rgb)
+        bounds = (0, 0, self.getWidth(), self.getHeight())
+        if not self._isOnScreen(bounds, (COMMAND_FILL_DISPLAY, c)):
+            self.iface._sendCommand(CMD_LAYOUT_COLOR, COMMAND_FILL_DISPLAY, c)
+
+            # Everything that was on screen is gone
+            self._drawn_regions.clear()
+            self._markDrawn(bounds, (COMMAND_FILL_DISPLAY, c))
 
     def getWidth(self):
         # TODO: Make this a real protocol/api thing
@@ -1,15 +1,61 @@
 
-import sys, select
+import os, sys, select, termios
 
 
 class StdIOStream:
+    # Most bytes taken from stdin by a single read
+    READ_SIZE = 4096
+
+    def __init__(self):
+        self._stdin_fd = sys.stdin.fileno()
+        self._read_buffer = bytearray(self.READ_SIZE)
 
     def write(self, data):
         sys.stdout.buffer.write(data)
         sys.stdout.buffer.flush()
 
     def available(self):
-        return select.select([sys.stdin,],[],[],0.0)[0]
+        return select.select([self._stdin_fd,],[],[],0.0)[0]
+
+    def wait(self, timeout = None):
+        '''Blocks until stdin has data, or timeout seconds pass.  Returns whether there is data.'''
+        return len(select.select([self._stdin_fd,],[],[],timeout)[0]) > 0
+
+    def readinto(self, buffer):
+        '''
+        Reads as many bytes as are ready (up to len(buffer)) into buffer without blocking,
+        and returns how many were read.
+        '''
+        if not self.available():
+            return 0
+
+        # Once select says stdin is readable, one read returns everything that's buffered
+        # without blocking.  We don't set O_NONBLOCK, because on the tablet stdin and stdout
+        # are the same serial tty and stdout writes would start failing with EAGAIN.
+        return os.readv(self._stdin_fd, [buffer])
 
     def read(self):
-        return sys.stdin.buffer.read(1)
+        '''Returns every byte that's ready (up to READ_SIZE), or b'' if there are none.'''
+        n = self.readinto(self._read_buffer)
+        return bytes(self._read_buffer[:n])
+
+    def setBaud(self, baud):
+        '''
+        Changes the baud rate of the serial tty behind stdin and stdout.  Output that was
+        already written goes out at the old rate first.  Raises ValueError if the tty can't
+        run at that rate, or isn't a tty at all.
+        '''
+        speed = getattr(termios, f'B{baud}', None)
+        if speed is None:
+            raise ValueError(f"Unsupported baud rate: {baud}")
+
+        sys.stdout.buffer.flush()
+        try:
+            attributes = termios.tcgetattr(self._stdin_fd)
+            attributes[4] = attributes[5] = speed
+            termios.tcsetattr(self._stdin_fd, termios.TCSADRAIN, attributes)
+        except termios.error as e:
+            raise ValueError(f"Can't set the baud rate to {baud}: {e}")
+
+    def fileno(self):
+        return self._stdin_fd